@@ -1,14 +1,36 @@
 from os import name
-from flask import Flask, render_template, request, redirect, session, flash, url_for
-from auth import UserSession
+import os
+import functools
+import threading
+import time
+import hashlib
+import io
+import click
+from datetime import timezone
+from flask import Flask, render_template, stream_template, request, redirect, session, flash, url_for, make_response, jsonify, abort, stream_with_context, g
+from auth import ServerSessionInterface, UserCache
 from notifications import NotificationManager
 from password_generator import PasswordBuilder
 from ui_manager import UIManager
 from recovery import RecoveryHandler, SecurityQuestionHandler
 from data_proxy import SensitiveDataProxy
 from recovery import RecoveryHandler
-from models import SecurityQuestion, VaultDetail, db, User, VaultItem
-from werkzeug.security import check_password_hash
+from sqlalchemy import update
+from models import SecurityQuestion, db, User, VaultItem
+from vault_repository import VaultRepository, VersionConflict
+from vault_cache import VaultSnapshotCache, snapshot_item, snapshot_page
+from key_manager import KeyManager
+from key_rotation import RotationJob, RotationWorker, start_rotation, rotation_status, retire_keys, seconds_until_retirable
+from db_metrics import QueryCounter
+from schema import upgrade_schema
+from query_plans import check_query_plans
+from benchmarks import bench_inserts, bench_crypto, bench_formats
+from vault_import import VaultImporter, PARSERS, detect_format
+from vault_export import export_lines, chunked, encrypt_stream, decrypt_stream
+from vault_search import search_items
+from vault_json import parse_fields, wants_details, wants_values, iter_items, stream_page, encode
+from rate_limiter import AdmissionControl, AdmissionRejected
+from hashing import password_hasher, HashingUnavailable, calibrate, hash_params_path, save_hash_method
 
 
 app = Flask(__name__)
@@ -16,24 +38,366 @@ app.jinja_env.globals.update(enumerate=enumerate)
 app.secret_key = "secretkey"  
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///CIS476_TermProject.db'  # Using SQLite
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # Suppress warnings
+app.config['VAULT_PAGE_SIZE'] = 50  # Items per vault page unless ?limit= asks otherwise
+app.config['VAULT_MAX_PAGE_SIZE'] = 500
+app.config['VAULT_SEARCH_PAGE_SIZE'] = 20
+app.config['VAULT_STREAM_RENDER'] = False  # Stream the whole vault instead of paging (?stream=1 per request)
+app.config['VAULT_STREAM_BATCH_SIZE'] = 100
+app.config['VAULT_IMPORT_BATCH_SIZE'] = 500  # Items committed per import transaction
+app.config['VAULT_IMPORT_MAX_ERRORS'] = 100  # Row errors listed in an import report
+app.config['VAULT_EXPORT_BATCH_SIZE'] = 500  # Items read per export query
+app.config['VAULT_CACHE_MAX_BYTES'] = 16 * 1024 * 1024  # Memory cap for cached vault pages
+app.config['METRICS_ENABLED'] = False  # Serve counters at /metrics; no login, so only on a private network
+app.config['HASH_POOL_WORKERS'] = os.cpu_count() or 1  # Processes for password hashing (0 = hash inline)
+app.config['HASH_POOL_MAX_QUEUE'] = 64  # Hashes queued or running before callers wait
+app.config['HASH_POOL_QUEUE_TIMEOUT'] = 5.0  # Seconds to wait for a queue slot before answering 503
+app.config['RATE_LIMIT_ENABLED'] = True  # Token buckets in front of every route that hashes
+app.config['RATE_LIMIT_IP_PER_MINUTE'] = 20  # Hashing requests per client IP, refilled continuously
+app.config['RATE_LIMIT_IP_BURST'] = 20
+app.config['RATE_LIMIT_ACCOUNT_PER_MINUTE'] = 5  # Attempts against one account, from any IP
+app.config['RATE_LIMIT_ACCOUNT_BURST'] = 10
+app.config['RATE_LIMIT_MAX_KEYS'] = 100000  # Buckets kept per limiter; least recently used go first
+app.config['RATE_LIMIT_MAX_CONCURRENT_HASHING'] = 32  # Hashing requests in flight before new ones get 429
+app.config['RATE_LIMIT_SAVE_INTERVAL'] = 30  # Seconds between saves of the bucket state to the instance folder
+app.config['PASSWORD_HASH_METHOD'] = None  # e.g. 'scrypt:65536:8:1'; None uses `flask calibrate-hash` output
+app.config['VAULT_KEY_CACHE_TTL'] = 300  # Seconds an unwrapped data key stays cached per session
+app.config['VAULT_CRYPTO_WORKERS'] = 0  # Threads for large encrypt/decrypt batches (0 = inline)
+app.config['VAULT_CRYPTO_MIN_BATCH'] = 512  # Smallest batch worth splitting across threads
+app.config['VAULT_ROTATION_WORKER'] = False  # Run unfinished key rotations in a background thread
+app.config['VAULT_ROTATION_BATCH_SIZE'] = 500  # Item keys rewrapped per rotation transaction
+app.config['VAULT_ROTATION_MAX_ROWS_PER_SEC'] = 2000  # Throttle for the background worker (0 = none)
+app.config['SESSION_LIFETIME'] = 3600  # Seconds of inactivity before a session expires
+app.config['SESSION_CACHE_SIZE'] = 10000  # Sessions kept in memory; the rest are read back from the database
+app.config['SESSION_REVALIDATE_AFTER'] = 30  # Seconds before a cached session is checked against the database
+app.config['SESSION_REAP_INTERVAL'] = 300  # Seconds between sweeps for expired sessions (0 = never)
+app.config['USER_CACHE_TTL'] = 60  # Seconds a logged-in user's record is reused before it is read again
+app.config['USER_CACHE_SIZE'] = 10000  # Users kept in the cache; least recently used go first
+app.config.from_prefixed_env()  # FLASK_<KEY> environment variables override any setting above
 db.init_app(app)
 
 
 # Initialize Singletons
-user_session = UserSession()
+session_interface = ServerSessionInterface(app)
+user_cache = UserCache(ttl=app.config['USER_CACHE_TTL'], max_entries=app.config['USER_CACHE_SIZE'])
 notification_manager = NotificationManager()
 ui_manager = UIManager()
+vault_repository = VaultRepository()
+vault_cache = VaultSnapshotCache(max_bytes=app.config['VAULT_CACHE_MAX_BYTES'])
+query_counter = QueryCounter(app)
+key_manager = KeyManager(app)
+password_hasher.init_app(app)
+admission_control = AdmissionControl(app)
+_background_lock = threading.Lock()
+_background_started = False
+
+@app.before_request
+def start_background_tasks():
+    # Background threads start with the first request rather than at import:
+    # the hashing pool's spawned workers re-import this module as __mp_main__
+    global _background_started
+    if _background_started:
+        return
+    with _background_lock:
+        if _background_started:
+            return
+        session_interface.start(app)
+        admission_control.start()
+        if app.config['VAULT_ROTATION_WORKER']:
+            RotationWorker(app, key_manager).start()
+        _background_started = True
+
+def form_details():
+    # Pair up the submitted detail keys and values, skipping empty ones
+    detail_keys = request.form.getlist('detail_key')  # List of keys
+    detail_values = request.form.getlist('detail_value')  # Corresponding values
+    return [(key, value) for key, value in zip(detail_keys, detail_values) if key and value]
+
+def current_cipher():
+    # The user's data key, unwrapped once per login session and cached
+    return key_manager.session_cipher(session.sid, g.user.id)
+
+@app.before_request
+def load_current_user():
+    # Resolve the logged-in user once per request, usually from the cache
+    user_id = session.get('user_id')
+    g.user = user_cache.get(user_id) if user_id is not None else None
+
+def login_required(message=None):
+    """
+    Decorator for views that need a logged-in user in g.user.
+    :param message: Flashed before redirecting to the login page; None
+                    answers with a JSON 401 instead, for API routes
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(*args, **kwargs):
+            if g.user is None:
+                if message is None:
+                    return api_error("Authentication required.", 401)
+                flash(message, "danger")
+                return redirect(url_for('login'))
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+def rehash_password(user_id, old_hash, password):
+    # Upgrade a hash made with outdated parameters, unless the password changed meanwhile
+    with app.app_context():
+        try:
+            db.session.execute(update(User).where(User.id == user_id, User.password_hash == old_hash)
+                               .values(password_hash=password_hasher.generate(password)))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Rehashing the password of user %s failed", user_id)
+
+def form_item_versions():
+    # Selected items arrive as "<id>:<version>" checkbox values
+    item_versions = {}
+    for value in request.form.getlist('item_ids'):
+        item_id, _, version = value.partition(':')
+        if item_id.isdigit() and version.isdigit():
+            item_versions[int(item_id)] = int(version)
+    return item_versions
+
+def conflict_response(user_id, item_ids, edited=None):
+    # 409 carrying the current state of the items the client was out of date on
+    message = "This item was changed in another window or device. Review the current version and try again."
+    if request.accept_mimetypes.best == 'application/json':
+        current = [item for item_id in item_ids
+                   for _, item in iter_items(vault_repository.item_rows(user_id, item_id=item_id, limit=1),
+                                             parse_fields(None), current_cipher())]
+        return app.response_class(encode({'error': message, 'current': current}),
+                                  status=409, mimetype='application/json')
+    items = [snapshot_item(item, current_cipher())
+             for item in VaultItem.query.filter(VaultItem.user_id == user_id, VaultItem.id.in_(item_ids))]
+    if edited is not None and items:
+        return render_template('modify_item.html', item=items[0], error=message), 409
+    return render_template('item_conflict.html', items=items, error=message), 409
+
+def page_args():
+    # Read the keyset cursor and page size from the query string
+    cursor = request.args.get('cursor') or None
+    limit = request.args.get('limit', app.config['VAULT_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['VAULT_MAX_PAGE_SIZE']))
+    return cursor, limit
+
+def buffered(chunks, size=8192):
+    # Join small template chunks so the server does not write a few bytes at a time
+    buffer, length = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+def vault_etag(user_id, revision):
+    # Strong validator for one rendering of one user's vault at one revision
+    raw = f"{user_id}:{revision.version}:{request.full_path}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def vault_not_modified(revision, etag):
+    # Answer a conditional GET without touching any vault rows
+    if request.if_none_match:
+        unchanged = request.if_none_match.contains(etag)
+    elif request.if_modified_since and revision.updated_at:
+        last_modified = revision.updated_at.replace(tzinfo=timezone.utc, microsecond=0)
+        unchanged = last_modified <= request.if_modified_since
+    else:
+        unchanged = False
+    if not unchanged:
+        return None
+    return add_vault_validators(app.response_class(status=304), revision, etag)
+
+def add_vault_validators(response, revision, etag):
+    response.set_etag(etag)
+    if revision.updated_at:
+        response.last_modified = revision.updated_at.replace(tzinfo=timezone.utc)
+    # Browsers must revalidate, and shared caches must never keep a vault
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 @app.cli.command('init-db')
 def init_db():
     db.create_all()
+    upgrade_schema()
     print("Database initialized.")
 
+@app.cli.command('upgrade-db')
+def upgrade_db():
+    upgrade_schema()
+    print("Database schema upgraded.")
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    failed = False
+    for label, plan, scans in check_query_plans():
+        failed = failed or bool(scans)
+        print(f"{'FAIL' if scans else 'ok'}: {label}")
+        for line in plan:
+            print(f"    {line}")
+    if failed:
+        raise SystemExit("One or more hot queries fall back to a full table scan.")
+    print("All hot queries use an index.")
+
+@app.cli.command('bench-inserts')
+@click.option('--items', default=200, help="Items inserted by each write path.")
+@click.option('--details', default=5, help="Details attached to every item.")
+def bench_inserts_command(items, details):
+    rates = bench_inserts(vault_repository, key_manager, items=items, details=details)
+    print(f"legacy (two commits, row-by-row details): {rates['legacy']:.1f} items/sec")
+    print(f"bulk (one transaction, executemany):      {rates['bulk']:.1f} items/sec")
+    print(f"speedup: {rates['bulk'] / rates['legacy']:.2f}x")
+
+@app.cli.command('bench-crypto')
+@click.option('--sizes', default='1,10,100,1000,10000', help="Comma-separated batch sizes.")
+@click.option('--workers', default=4, help="Threads for the parallel batch run.")
+def bench_crypto_command(sizes, workers):
+    print(f"{'batch':>7} {'op':>8} {'per value':>12} {'batch':>12} {f'{workers} threads':>12}  (values/sec)")
+    for row in bench_crypto([int(size) for size in sizes.split(',')], workers=workers):
+        print(f"{row['size']:>7} {row['op']:>8} {row['single']:>12.0f} {row['batch']:>12.0f} {row['parallel']:>12.0f}")
+    print()
+    print(f"{'format':>15} {'stored bytes':>13} {'encrypt/sec':>12} {'decrypt/sec':>12}")
+    for row in bench_formats():
+        print(f"{row['format']:>15} {row['bytes']:>13} {row['encrypt']:>12.0f} {row['decrypt']:>12.0f}")
+
+@app.cli.command('migrate-secrets')
+@click.option('--batch-size', default=500, help="Items rewritten per transaction.")
+def migrate_secrets_command(batch_size):
+    migrated, scanned = key_manager.migrate_values(
+        batch_size=batch_size,
+        progress=lambda migrated, scanned, rate: print(f"{scanned} scanned, {migrated} migrated, {rate:.0f} items/sec"),
+    )
+    print(f"Migrated {migrated} of {scanned} items to per-item keys.")
+
+@app.cli.command('rotate-keys')
+@click.option('--batch-size', type=int, default=None, help="Items rewrapped per transaction.")
+@click.option('--max-rows-per-sec', type=int, default=0, help="Throttle; 0 runs flat out.")
+@click.option('--detach', is_flag=True, help="Only start the rotation and leave the rows to the background worker.")
+def rotate_keys_command(batch_size, max_rows_per_sec, detach):
+    rotation = start_rotation(key_manager)
+    print(f"Rotation {rotation.id} in progress from item id {rotation.last_item_id}.")
+    if detach:
+        return
+
+    def progress(p):
+        print(f"{p.scanned} scanned, {p.remaining} left, {p.rows_per_sec:.0f} rows/sec, ETA {p.eta_seconds:.0f}s")
+
+    job = RotationJob(key_manager, rotation.id,
+                      batch_size=batch_size or app.config['VAULT_ROTATION_BATCH_SIZE'],
+                      max_rows_per_sec=max_rows_per_sec, progress=progress)
+    if not job.run():
+        raise SystemExit("Another process is running this rotation; try again once it stops.")
+    print(f"Rotation {rotation.id} finished; {rotation.items_rewritten} item keys rewrapped.")
+
+    # Old keys go once no process can still be encrypting with them
+    wait = seconds_until_retirable(key_manager, rotation)
+    if wait:
+        print(f"Waiting {wait:.0f}s for cached keys to expire before retiring the old ones.")
+        time.sleep(wait)
+    print(f"{retire_keys(key_manager, rotation)} superseded data keys retired.")
+
+@app.cli.command('calibrate-hash')
+@click.option('--target-ms', default=150, help="Latency budget for one password hash.")
+@click.option('--algorithm', type=click.Choice(['scrypt', 'pbkdf2']), default='scrypt')
+def calibrate_hash_command(target_ms, algorithm):
+    method, ms = calibrate(algorithm, target_ms, progress=lambda method, ms: print(f"{method}: {ms:.0f} ms"))
+    path = hash_params_path(app)
+    save_hash_method(path, method, ms)
+    print(f"Using {method} ({ms:.0f} ms per hash), saved to {path}.")
+    print("Existing passwords are rehashed with it the next time their owner logs in.")
+
+@app.cli.command('import-vault')
+@click.argument('email')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['auto', *PARSERS]), default='auto')
+@click.option('--batch-size', type=int, default=None, help="Items committed per transaction.")
+def import_vault_command(email, path, file_format, batch_size):
+    user = User.query.filter_by(email=email).first()
+    if not user:
+        raise SystemExit(f"No user registered with {email}.")
+    if file_format == 'auto':
+        file_format = detect_format(path)
+
+    importer = VaultImporter(
+        vault_repository, key_manager.user_cipher(user.id),
+        batch_size=batch_size or app.config['VAULT_IMPORT_BATCH_SIZE'],
+        max_errors=app.config['VAULT_IMPORT_MAX_ERRORS'],
+        progress=lambda imported, failed, rate: print(f"{imported} imported, {failed} failed, {rate:.0f} rows/sec"),
+    )
+    with open(path, encoding='utf-8-sig', newline='') as lines:
+        try:
+            report = importer.run(user.id, PARSERS[file_format](lines))
+        except ValueError as e:
+            raise SystemExit(str(e))
+    vault_cache.invalidate(user.id)
+
+    for error in report.errors:
+        print(error)
+    print(f"Imported {report.imported} items, {report.failed} failed, "
+          f"in {report.seconds:.2f}s ({report.rows_per_sec:.0f} rows/sec).")
+
+@app.cli.command('export-vault')
+@click.argument('email')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--encrypt', is_flag=True, help="Wrap the export in an encrypted container.")
+def export_vault_command(email, path, encrypt):
+    user = User.query.filter_by(email=email).first()
+    if not user:
+        raise SystemExit(f"No user registered with {email}.")
+
+    rows = vault_repository.item_rows(user.id, limit=None, batch_size=app.config['VAULT_EXPORT_BATCH_SIZE'])
+    chunks = chunked(export_lines(rows, key_manager.user_cipher(user.id)))
+    if encrypt:
+        passphrase = click.prompt("Export passphrase", hide_input=True, confirmation_prompt=True)
+        chunks = encrypt_stream(chunks, passphrase)
+    with open(path, 'wb') as out:
+        for chunk in chunks:
+            out.write(chunk)
+    print(f"Vault of {email} exported to {path}.")
+
+@app.cli.command('decrypt-export')
+@click.argument('source', type=click.File('rb'))
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+def decrypt_export_command(source, path):
+    passphrase = click.prompt("Export passphrase", hide_input=True)
+    try:
+        with open(path, 'wb') as out:
+            for chunk in decrypt_stream(source, passphrase):
+                out.write(chunk)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    print(f"Decrypted export written to {path}.")
+
+@app.route('/metrics')
+def metrics():
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    return jsonify(vault_cache=vault_cache.stats(), key_rotation=rotation_status(),
+                   password_hashing=password_hasher.stats(), admission_control=admission_control.stats(),
+                   sessions=session_interface.store.stats(), users=user_cache.stats())
+
+@app.errorhandler(AdmissionRejected)
+def admission_rejected(e):
+    return render_template('busy.html', error="Too many attempts. Please wait a moment and try again."), 429, \
+        {'Retry-After': str(e.retry_after)}
+
+@app.errorhandler(HashingUnavailable)
+def hashing_unavailable(e):
+    # Every hashing slot stayed taken for HASH_POOL_QUEUE_TIMEOUT seconds
+    return render_template('busy.html', error="The server is busy. Please try again in a few seconds."), 503, \
+        {'Retry-After': '5'}
+
 @app.route('/')
 def home():
     return render_template('index.html')
 
 @app.route('/register', methods=['GET', 'POST'])
+@admission_control.guard()
 def register():
     predefined_questions = [
         "What was the name of your first pet?",
@@ -66,18 +430,18 @@ def register():
             flash("Email already registered. Please log in.", "danger")
             return redirect(url_for('login'))
 
+        # Hash the password and the answers in parallel on the hashing pool
+        password_hash, *answer_hashes = password_hasher.generate_many(
+            [password, *(SecurityQuestion.normalize_answer(answer) for answer in answers)])
+
         # Create and save the user
-        user = User(email=email)
-        user.set_password(password)
+        user = User(email=email, password_hash=password_hash)
         db.session.add(user)
         db.session.commit()  # Commit user first to get the user.id
 
         # Add security questions and answers
-        for question, answer in zip(predefined_questions[:3], answers):
-            if answer:
-                security_question = SecurityQuestion(question=question, user=user)
-                security_question.set_answer(answer)
-                db.session.add(security_question)
+        for question, answer_hash in zip(predefined_questions[:3], answer_hashes):
+            db.session.add(SecurityQuestion(question=question, user=user, answer_hash=answer_hash))
 
         db.session.commit()  # Save all changes
 
@@ -88,6 +452,7 @@ def register():
 
 
 @app.route('/login', methods=['GET', 'POST'])
+@admission_control.guard()
 def login():
      if request.method == 'POST':
         email = request.form['email']
@@ -97,11 +462,16 @@ def login():
         user = User.query.filter_by(email=email).first()
 
         # Check if user exists and verify the password
-        if user and check_password_hash(user.password_hash, password):
+        if user and user.check_password(password):
+            if password_hasher.needs_rehash(user.password_hash):
+                password_hasher.background(rehash_password, user.id, user.password_hash, password)
             # Store user information in the session
+            session.regenerate()  # Fresh session id, so one set before login is useless
             session['user_id'] = user.id
             session['email'] = user.email  # Store additional user info if needed
-            
+            key_manager.unlock(session.sid, user.id)  # Unwrap the data key once for this session
+            db.session.commit()  # Store a first data key before the session encrypts with it
+
             flash("Login successful!", "success")
             return redirect(url_for('vault'))  # Redirect to the user's vault or home page
             
@@ -113,15 +483,9 @@ def login():
      return render_template('login.html')
 
 @app.route('/vault', methods=['GET', 'POST'])
+@login_required("Please log in to access your vault.")
 def vault():
-    if 'user_id' not in session:
-        flash("Please log in to access your vault.", "danger")
-        return redirect(url_for('login'))
-
-    user_id = session['user_id']
-
-    # Fetch user's vault items and their details
-    vault_items = VaultItem.query.filter_by(user_id=user_id).all()
+    user_id = g.user.id
 
     if request.method == 'POST':
         # Handle adding a new vault item
@@ -132,30 +496,167 @@ def vault():
             flash("Item type and name are required.", "danger")
             return redirect(url_for('vault'))
 
-        # Create and add the new VaultItem
-        new_item = VaultItem(user_id=user_id, item_type=item_type, name=name)
-        db.session.add(new_item)
-        db.session.commit()
-
-        # Add details for the new item
-        detail_keys = request.form.getlist('detail_key')  # List of keys
-        detail_values = request.form.getlist('detail_value')  # Corresponding values
-
-        for key, value in zip(detail_keys, detail_values):
-            if key and value:  # Ensure non-empty key-value pairs
-                new_detail = VaultDetail(vault_item_id=new_item.id, key=key, value=value)
-                db.session.add(new_detail)
-
-        db.session.commit()
+        # Create the new VaultItem and its details in one transaction
+        vault_repository.create_item(user_id, item_type, name, form_details(), current_cipher())
+        vault_cache.invalidate(user_id)
         flash("Vault item added successfully!", "success")
         return redirect(url_for('vault'))
 
+    # An unchanged vault costs one lookup on users and nothing else
+    revision = vault_repository.revision(user_id)
+    etag = vault_etag(user_id, revision)
+    not_modified = vault_not_modified(revision, etag)
+    if not_modified:
+        return not_modified
+
+    # Stream the entire vault straight from the item query when asked to
+    if request.args.get('stream', int(app.config['VAULT_STREAM_RENDER']), type=int):
+        cipher = current_cipher()
+        vault_items = (snapshot_item(item, cipher) for item in
+                       vault_repository.iter_items(user_id, batch_size=app.config['VAULT_STREAM_BATCH_SIZE']))
+        response = app.response_class(buffered(stream_template('vault.html', vault_items=vault_items)),
+                                      mimetype='text/html')
+        return add_vault_validators(response, revision, etag)
+
+    # Fetch one page of the user's vault items, reusing the cached snapshot
+    # while the vault version stored in the database is unchanged
+    cursor, limit = page_args()
+    try:
+        vault_page, cache_hit = vault_cache.get_or_load(
+            (user_id, cursor, limit), revision.version,
+            lambda: snapshot_page(vault_repository.page(user_id, cursor=cursor, limit=limit), current_cipher()))
+    except ValueError as e:
+        flash(str(e), "danger")
+        return redirect(url_for('vault'))
+
     # Render the vault page with items and details
-    return render_template('vault.html', vault_items=vault_items)
+    response = make_response(render_template('vault.html', vault_items=vault_page.items,
+                                             next_cursor=vault_page.next_cursor, cursor=cursor, limit=limit))
+    response.headers['X-Vault-Cache'] = 'hit' if cache_hit else 'miss'
+    return add_vault_validators(response, revision, etag)
 
     return ui_manager.render_vault(vault_items)
     
 
+@app.route('/vault/search')
+@login_required("Please log in to search your vault.")
+def vault_search():
+    query = request.args.get('q', '').strip()
+    page = max(1, request.args.get('page', 1, type=int))
+    results = search_items(db.session, g.user.id, query,
+                           page=page, per_page=app.config['VAULT_SEARCH_PAGE_SIZE'])
+    return render_template('vault_search.html', query=query, search_page=results)
+
+
+@app.route('/vault/import', methods=['GET', 'POST'])
+@login_required("Please log in to import items into your vault.")
+def import_vault():
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash("Choose a file to import.", "danger")
+            return render_template('import_vault.html', formats=PARSERS)
+
+        file_format = request.form.get('format', 'auto')
+        if file_format not in PARSERS:
+            file_format = detect_format(upload.filename)
+
+        # Parse the upload as a stream; Werkzeug spools large files to disk
+        user_id = g.user.id
+        lines = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        importer = VaultImporter(vault_repository, current_cipher(),
+                                 batch_size=app.config['VAULT_IMPORT_BATCH_SIZE'],
+                                 max_errors=app.config['VAULT_IMPORT_MAX_ERRORS'])
+        try:
+            report = importer.run(user_id, PARSERS[file_format](lines))
+        except (ValueError, UnicodeDecodeError) as e:
+            flash(f"Could not read the file: {e}", "danger")
+            return render_template('import_vault.html', formats=PARSERS)
+        vault_cache.invalidate(user_id)
+
+        flash(f"Imported {report.imported} items ({report.failed} failed).",
+              "success" if not report.failed else "danger")
+        return render_template('import_vault.html', formats=PARSERS, report=report)
+
+    return render_template('import_vault.html', formats=PARSERS)
+
+@app.route('/vault/export', methods=['GET', 'POST'])
+@login_required("Please log in to export your vault.")
+def export_vault():
+    if request.method == 'POST':
+        passphrase = request.form.get('passphrase', '')
+        if passphrase != request.form.get('confirm_passphrase', ''):
+            flash("Passphrases do not match.", "danger")
+            return render_template('export_vault.html')
+
+        # Rows come off the cursor in batches and leave as chunked transfer
+        # encoding, so the vault is never held in memory as a whole
+        rows = vault_repository.item_rows(g.user.id, limit=None,
+                                          batch_size=app.config['VAULT_EXPORT_BATCH_SIZE'])
+        chunks = chunked(export_lines(rows, current_cipher()))
+        filename = 'vault-export.jsonl'
+        if passphrase:
+            chunks = encrypt_stream(chunks, passphrase)
+            filename += '.enc'
+        response = app.response_class(stream_with_context(chunks), mimetype='application/octet-stream')
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response.cache_control.no_store = True
+        return response
+
+    return render_template('export_vault.html')
+
+def api_error(message, status):
+    return app.response_class(encode({'error': message}), status=status, mimetype='application/json')
+
+@app.route('/api/vault')
+@login_required()
+def api_vault():
+    user_id = g.user.id
+    revision = vault_repository.revision(user_id)
+    etag = vault_etag(user_id, revision)
+    not_modified = vault_not_modified(revision, etag)
+    if not_modified:
+        return not_modified
+
+    cursor, limit = page_args()
+    try:
+        fields = parse_fields(request.args.get('fields'))
+        rows = vault_repository.item_rows(user_id, cursor=cursor, limit=limit,
+                                          with_details=wants_details(fields),
+                                          with_values=wants_values(fields))
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    # Items are encoded one at a time as rows come off the cursor
+    response = app.response_class(stream_with_context(buffered(stream_page(rows, fields, limit, current_cipher()))),
+                                  mimetype='application/json')
+    return add_vault_validators(response, revision, etag)
+
+@app.route('/api/vault/<int:item_id>')
+@login_required()
+def api_vault_item(item_id):
+    user_id = g.user.id
+    revision = vault_repository.revision(user_id)
+    etag = vault_etag(user_id, revision)
+    not_modified = vault_not_modified(revision, etag)
+    if not_modified:
+        return not_modified
+
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return api_error(str(e), 400)
+    rows = vault_repository.item_rows(user_id, item_id=item_id, limit=1,
+                                      with_details=wants_details(fields),
+                                      with_values=wants_values(fields))
+    item = next((item for _, item in iter_items(rows, fields, current_cipher())), None)
+    if item is None:
+        return api_error("Item not found.", 404)
+
+    response = app.response_class(encode(item), mimetype='application/json')
+    return add_vault_validators(response, revision, etag)
+
+
 @app.route('/generate_password', methods=['GET', 'POST'])
 def generate_password():
     if request.method == 'POST':
@@ -167,6 +668,7 @@ def generate_password():
 
 
 @app.route('/recover_password', methods=['GET', 'POST'])
+@admission_control.guard()
 def recover_password():
     if request.method == 'POST':
         email = request.form['email']
@@ -201,18 +703,19 @@ def recover_password():
 
 @app.route('/logout')
 def logout():
+    key_manager.forget(session.sid)
+    if 'user_id' in session:
+        vault_cache.invalidate(session['user_id'])  # Decrypted values must not outlive the login
     session.clear()  # Clear the session to log the user out
+    session.regenerate()  # Drops the stored record; the flash below goes into a fresh one
     flash("You have been logged out successfully.", "success")
     return redirect(url_for('login'))
 
 @app.route('/add_item', methods=['GET', 'POST'])
+@login_required("Please log in to add items to your vault.")
 def add_item():
-    if 'user_id' not in session:
-        flash("Please log in to add items to your vault.", "danger")
-        return redirect(url_for('login'))
-
     if request.method == 'POST':
-        user_id = session['user_id']
+        user_id = g.user.id
         item_type = request.form.get('item_type')  # 'Login', 'Credit Card', etc.
         name = request.form.get('name')  # Friendly name for the item
 
@@ -220,21 +723,9 @@ def add_item():
             flash("Item type and name are required.", "danger")
             return render_template('add_item.html')
 
-        # Create and add the new VaultItem
-        new_item = VaultItem(user_id=user_id, item_type=item_type, name=name)
-        db.session.add(new_item)
-        db.session.commit()
-
-        # Add details for the new item
-        detail_keys = request.form.getlist('detail_key')  # List of keys
-        detail_values = request.form.getlist('detail_value')  # Corresponding values
-
-        for key, value in zip(detail_keys, detail_values):
-            if key and value:  # Ensure non-empty key-value pairs
-                new_detail = VaultDetail(vault_item_id=new_item.id, key=key, value=value)
-                db.session.add(new_detail)
-
-        db.session.commit()
+        # Create the new VaultItem and its details in one transaction
+        vault_repository.create_item(user_id, item_type, name, form_details(), current_cipher())
+        vault_cache.invalidate(user_id)
         flash("Vault item added successfully!", "success")
         return redirect(url_for('vault'))
 
@@ -242,12 +733,9 @@ def add_item():
     return render_template('add_item.html')
 
 @app.route('/modify_item/<int:item_id>', methods=['GET', 'POST'])
+@login_required("Please log in to modify items in your vault.")
 def modify_item(item_id):
-    if 'user_id' not in session:
-        flash("Please log in to modify items in your vault.", "danger")
-        return redirect(url_for('login'))
-
-    user_id = session['user_id']
+    user_id = g.user.id
     item = VaultItem.query.filter_by(id=item_id, user_id=user_id).first()
 
     if not item:
@@ -255,33 +743,76 @@ def modify_item(item_id):
         return redirect(url_for('vault'))
 
     if request.method == 'POST':
-        # Update item details
-        item.name = request.form.get('name', item.name)
-        item.item
+        name = request.form.get('name', item.name)
+        item_type = request.form.get('item_type', item.item_type)
 
-@app.route('/delete_item/<int:item_id>', methods=['POST'])
-def delete_item(item_id):
-    if 'user_id' not in session:
-        flash("Please log in to delete items from your vault.", "danger")
-        return redirect(url_for('login'))
+        if not item_type or not name:
+            flash("Item type and name are required.", "danger")
+            return render_template('modify_item.html', item=snapshot_item(item, current_cipher()))
+
+        expected_version = request.form.get('version', type=int)
+        if expected_version is None:
+            abort(400)
+
+        # Write only the rows that differ from what is stored, and only if
+        # nobody else saved the item since this form was loaded
+        try:
+            updated = vault_repository.update_item(item, expected_version, name, item_type, form_details(),
+                                                   current_cipher())
+        except VersionConflict as e:
+            return conflict_response(user_id, e.item_ids, edited=item_id)
+        if updated:
+            vault_cache.invalidate(user_id)
+            flash("Vault item updated successfully!", "success")
+        else:
+            flash("No changes to save.", "success")
+        return redirect(url_for('vault'))
 
-    user_id = session['user_id']
-    item = VaultItem.query.filter_by(id=item_id, user_id=user_id).first()
+    # Render the edit form for GET requests
+    return render_template('modify_item.html', item=snapshot_item(item, current_cipher()))
 
-    if not item:
+@app.route('/delete_item/<int:item_id>', methods=['POST'])
+@login_required("Please log in to delete items from your vault.")
+def delete_item(item_id):
+    user_id = g.user.id
+    expected_version = request.form.get('version', type=int)
+    if expected_version is None:
+        abort(400)
+
+    # Delete the item if it is still at the version the user saw; the
+    # database removes its details
+    try:
+        deleted = vault_repository.delete_items(user_id, {item_id: expected_version})
+    except VersionConflict as e:
+        return conflict_response(user_id, e.item_ids)
+    if not deleted:
         flash("Item not found or you do not have permission to delete this item.", "danger")
         return redirect(url_for('vault'))
-
-    # Delete the item and its details
-    VaultDetail.query.filter_by(vault_item_id=item.id).delete()
-    db.session.delete(item)
-    db.session.commit()
+    vault_cache.invalidate(user_id)
 
     flash("Item deleted successfully!", "success")
     return redirect(url_for('vault'))
 
+@app.route('/delete_items', methods=['POST'])
+@login_required("Please log in to delete items from your vault.")
+def delete_items():
+    user_id = g.user.id
+    item_versions = form_item_versions()
+    if not item_versions:
+        flash("Select at least one item to delete.", "danger")
+        return redirect(url_for('vault'))
+
+    try:
+        deleted = vault_repository.delete_items(user_id, item_versions)
+    except VersionConflict as e:
+        return conflict_response(user_id, e.item_ids)
+    vault_cache.invalidate(user_id)
+    flash(f"{deleted} item(s) deleted successfully!", "success")
+    return redirect(url_for('vault'))
+
 
 @app.route('/reset_password/<int:user_id>', methods=['GET', 'POST'])
+@admission_control.guard(account=lambda: f"user:{request.view_args['user_id']}")
 def reset_password(user_id):
     user = User.query.get(user_id)
     if not user:
@@ -298,6 +829,13 @@ def reset_password(user_id):
 
         user.set_password(new_password)  # Hash the new password
         db.session.commit()  # Save the changes
+        # Log the user out everywhere and stop serving the cached record
+        user_cache.invalidate(user.id)
+        vault_cache.invalidate(user.id)
+        for sid in session_interface.store.delete_user(user.id):
+            key_manager.forget(sid)
+        if session.get('user_id') == user.id:
+            session.clear()
         flash("Your password has been reset successfully! You may now log in.", "success")
         return redirect(url_for('login'))
 
@@ -1,20 +1,302 @@
-# User Authentication using Singleton Pattern
-class UserSession:
-    _instance = None
+# User Sessions using a Server-Side Session Store
+import secrets
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from flask import got_request_exception
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from sqlalchemy import select, delete, update
+from sqlalchemy.orm import Session
+from models import db, ServerSessionRecord, User
 
-    def __new__(cls, *args, **kwargs):
-        if not cls._instance:
-            cls._instance = super(UserSession, cls).__new__(cls, *args, **kwargs)
-        return cls._instance
 
-    def __init__(self):
-        self.user = None
+# What routes need to know about the logged-in user, without the ORM row
+CurrentUser = namedtuple('CurrentUser', ['id', 'email'])
 
-    def login(self, user):
-        self.user = user
 
-    def logout(self):
-        self.user = None
+class ServerSession(CallbackDict, SessionMixin):
+    """
+    Session data kept on the server. The cookie only carries the
+    random session id.
+    """
 
-    def is_authenticated(self):
-        return self.user is not None
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        # New id for the same data, e.g. at login, so an id planted before
+        # authentication is worthless afterwards
+        if self.previous_sid is None and not self.new:
+            self.previous_sid = self.sid
+        self.sid = new_session_id()
+        self.modified = True
+
+
+def new_session_id():
+    return secrets.token_urlsafe(32)
+
+
+class SessionStore:
+    """
+    Session records by id: an in-memory LRU in front of the server_sessions
+    table. Lookups are one dict access; the table is read on a miss (a
+    session started in another worker, or before a restart) and when a
+    cached record is older than revalidate_after seconds, so a logout in
+    another worker is seen within that time.
+
+    The table is read and written through a session of its own, never the
+    request's db.session, so saving a session does not commit (or roll
+    back) whatever the view left pending.
+    """
+
+    def __init__(self, lifetime=3600, max_entries=10000, revalidate_after=30):
+        self.lifetime = lifetime
+        self.max_entries = max_entries
+        self.revalidate_after = revalidate_after
+        self.serializer = TaggedJSONSerializer()
+        self._entries = OrderedDict()  # sid -> [data, expires_at, loaded_at, stored_expires_at]
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._loads = 0
+
+    def get(self, sid):
+        """
+        Data of a live session, extending its expiry, or None.
+        :param sid: Session id from the cookie
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry and entry[1] > now and now - entry[2] < self.revalidate_after:
+                self._entries.move_to_end(sid)
+                entry[1] = now + self.lifetime
+                self._hits += 1
+                return entry[0]
+            self._loads += 1
+
+        with Session(db.engine) as store:
+            record = store.get(ServerSessionRecord, sid)
+        if record is None or record.expires_at <= now:
+            with self._lock:
+                self._entries.pop(sid, None)
+            return None
+        data = self.serializer.loads(record.data)
+        self._cache(sid, data, now + self.lifetime, now, record.expires_at)
+        return data
+
+    def save(self, sid, data, user_id=None):
+        """
+        Write a session's data through to the table.
+        :param sid: Session id
+        :param data: Plain dict of session values
+        :param user_id: Logged-in user, kept in its own column
+        """
+        now = time.time()
+        expires_at = now + self.lifetime
+        with Session(db.engine) as store, store.begin():
+            store.merge(ServerSessionRecord(id=sid, data=self.serializer.dumps(data),
+                                            user_id=user_id, expires_at=expires_at))
+        self._cache(sid, data, expires_at, now, expires_at)
+
+    def touch(self, sid):
+        """
+        Slide the expiry of an unchanged session. The table is only written
+        once the stored expiry lags by more than a tenth of the lifetime.
+        :param sid: Session id
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None or entry[3] - now > self.lifetime * 0.9:
+                return
+            entry[3] = entry[1]
+            expires_at = entry[1]
+        with Session(db.engine) as store, store.begin():
+            store.execute(update(ServerSessionRecord).where(ServerSessionRecord.id == sid)
+                          .values(expires_at=expires_at))
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+        with Session(db.engine) as store, store.begin():
+            store.execute(delete(ServerSessionRecord).where(ServerSessionRecord.id == sid))
+
+    def delete_user(self, user_id):
+        """
+        End every session of a user, e.g. after a password reset. Returns
+        the deleted session ids.
+        :param user_id: The user's id
+        """
+        with Session(db.engine) as store, store.begin():
+            sids = set(store.scalars(select(ServerSessionRecord.id).where(ServerSessionRecord.user_id == user_id)))
+            store.execute(delete(ServerSessionRecord).where(ServerSessionRecord.user_id == user_id))
+        with self._lock:
+            sids.update(sid for sid, entry in self._entries.items() if entry[0].get('user_id') == user_id)
+            for sid in sids:
+                self._entries.pop(sid, None)
+        return sids
+
+    def reap(self):
+        """
+        Remove expired sessions from memory and from the table. Rows get a
+        grace of a tenth of the lifetime, since touch lets a session in use
+        run that far ahead of its stored expiry.
+        """
+        now = time.time()
+        with self._lock:
+            for sid in [sid for sid, entry in self._entries.items() if entry[1] <= now]:
+                del self._entries[sid]
+        with Session(db.engine) as store, store.begin():
+            removed = store.execute(delete(ServerSessionRecord).where(
+                ServerSessionRecord.expires_at <= now - self.lifetime * 0.1)).rowcount
+        return removed
+
+    def _cache(self, sid, data, expires_at, loaded_at, stored_expires_at):
+        with self._lock:
+            self._entries[sid] = [data, expires_at, loaded_at, stored_expires_at]
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {'cached': len(self._entries), 'hits': self._hits, 'loads': self._loads}
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Flask session interface backed by a SessionStore. Set up with
+    init_app; start runs the reaper thread.
+    """
+
+    def __init__(self, app=None):
+        self.store = SessionStore()
+        self.reap_interval = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Read SESSION_LIFETIME, SESSION_CACHE_SIZE, SESSION_REVALIDATE_AFTER
+        and SESSION_REAP_INTERVAL, and install the interface on the app.
+        :param app: The Flask application
+        """
+        self.store = SessionStore(lifetime=app.config['SESSION_LIFETIME'],
+                                  max_entries=app.config['SESSION_CACHE_SIZE'],
+                                  revalidate_after=app.config['SESSION_REVALIDATE_AFTER'])
+        app.session_interface = self
+        self.reap_interval = app.config.get('SESSION_REAP_INTERVAL', 0)
+        got_request_exception.connect(self._discard_request_writes, app)
+
+    def start(self, app):
+        # Start the reaper thread; called once by the serving process
+        if self.reap_interval:
+            threading.Thread(target=self._reap_every, args=(app, self.reap_interval), name='session-reaper',
+                             daemon=True).start()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and len(sid) <= 64:
+            data = self.store.get(sid)
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        return ServerSession(sid=new_session_id(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.previous_sid:
+            self.store.delete(session.previous_sid)
+
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.modified or session.new:
+            self.store.save(session.sid, dict(session), session.get('user_id'))
+            response.set_cookie(name, session.sid, domain=domain, path=path,
+                                httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+        else:
+            self.store.touch(session.sid)
+
+    @staticmethod
+    def _discard_request_writes(sender, **extra):
+        # A view that failed may have flushed writes it never committed; they
+        # are dropped at teardown anyway, and on SQLite their lock would keep
+        # the session from being saved until the busy timeout runs out
+        db.session.rollback()
+
+    def _reap_every(self, app, interval):
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    self.store.reap()
+                except Exception:
+                    app.logger.exception("Reaping expired sessions failed")
+
+
+class UserCache:
+    """
+    Read-through cache of CurrentUser records by user id. Entries are
+    reloaded after ttl seconds and dropped by invalidate, so an
+    authenticated request usually resolves its user without a query.
+    """
+
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # user_id -> (CurrentUser, loaded_at)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._loads = 0
+
+    def get(self, user_id):
+        """
+        The user with this id, or None if it no longer exists.
+        :param user_id: Id from the session
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and now - entry[1] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self._hits += 1
+                return entry[0]
+            self._loads += 1
+
+        row = db.session.execute(select(User.id, User.email).where(User.id == user_id)).first()
+        user = CurrentUser(*row) if row else None
+        with self._lock:
+            if user is None:
+                self._entries.pop(user_id, None)
+            else:
+                self._entries[user_id] = (user, now)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {'cached': len(self._entries), 'hits': self._hits, 'loads': self._loads}
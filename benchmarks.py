@@ -0,0 +1,117 @@
+# Throughput Benchmarks run against the configured database
+import time
+from cryptography.fernet import Fernet
+from key_manager import VaultCipher
+from models import db, User, VaultItem, VaultDetail, DataKey, encrypt_data, decrypt_data, encrypt_many, decrypt_many
+
+
+BENCH_EMAIL = 'benchmark@localhost.invalid'
+
+
+def _bench_user():
+    # Throwaway owner for benchmark rows; its password hash can never match
+    user = User.query.filter_by(email=BENCH_EMAIL).first()
+    if user is None:
+        user = User(email=BENCH_EMAIL, password_hash='!')
+        db.session.add(user)
+        db.session.commit()
+    return user
+
+
+def _cleanup(user):
+    DataKey.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    item_ids = db.session.query(VaultItem.id).filter_by(user_id=user.id)
+    VaultDetail.query.filter(VaultDetail.vault_item_id.in_(item_ids.scalar_subquery())).delete(synchronize_session=False)
+    VaultItem.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    db.session.delete(user)
+    db.session.commit()
+
+
+def _legacy_create_item(user_id, item_type, name, details, cipher):
+    # The write path the routes used before create_item: two commits and
+    # one INSERT statement per detail
+    item = VaultItem(user_id=user_id, item_type=item_type, name=name)
+    db.session.add(item)
+    db.session.commit()
+    for key, value in details:
+        db.session.add(VaultDetail(vault_item_id=item.id, key=key, value=encrypt_data(value, cipher)))
+    db.session.commit()
+
+
+def _rate(count, func):
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    return count / (time.perf_counter() - start)
+
+
+def bench_inserts(repository, key_manager, items=200, details=5):
+    """
+    Compare item inserts per second for the legacy and the bulk write path.
+    :param repository: VaultRepository providing create_item
+    :param key_manager: KeyManager providing the benchmark user's cipher
+    :param items: Items inserted by each strategy
+    :param details: Details attached to every item
+    """
+    user = _bench_user()
+    pairs = [(f'key{d}', f'value{d}') for d in range(details)]
+    try:
+        cipher = key_manager.user_cipher(user.id)
+        legacy = _rate(items, lambda i: _legacy_create_item(user.id, 'Login', f'legacy{i}', pairs, cipher))
+        bulk = _rate(items, lambda i: repository.create_item(user.id, 'Login', f'bulk{i}', pairs, cipher))
+    finally:
+        _cleanup(user)
+    return {'legacy': legacy, 'bulk': bulk}
+
+
+def bench_crypto(sizes=(1, 10, 100, 1000, 10000), workers=4, value='correct horse battery staple'):
+    """
+    Compare values per second for one-at-a-time, batched and threaded batch
+    encryption and decryption. Needs no database.
+    :param sizes: Batch sizes to measure
+    :param workers: Threads used by the parallel batch run
+    :param value: Plaintext used for every value
+    """
+    cipher = VaultCipher([(1, Fernet.generate_key())])
+    results = []
+    for size in sizes:
+        values = [value] * size
+        tokens = encrypt_many(values, cipher, workers=0)
+        # Repeat small batches so every measurement covers enough values
+        rounds = max(1, 10000 // size)
+        for op, single, many, data in (
+            ('encrypt', encrypt_data, encrypt_many, values),
+            ('decrypt', decrypt_data, decrypt_many, tokens),
+        ):
+            results.append({
+                'size': size,
+                'op': op,
+                'single': _rate(rounds, lambda i: [single(item, cipher) for item in data]) * size,
+                'batch': _rate(rounds, lambda i: many(data, cipher, workers=0)) * size,
+                'parallel': _rate(rounds, lambda i: many(data, cipher, workers=workers)) * size,
+            })
+    return results
+
+
+def bench_formats(count=10000, value='correct horse battery staple'):
+    """
+    Compare the legacy Fernet text format with the binary AES-GCM format:
+    stored bytes per value and values per second in each direction.
+    :param count: Values encrypted and decrypted per format
+    :param value: Plaintext used for every value
+    """
+    data_key = Fernet.generate_key()
+    values = [value] * count
+    results = []
+    for name, cipher, store in (
+        ('fernet text', Fernet(data_key), lambda token: token.decode('ascii')),
+        ('aes-gcm binary', VaultCipher([(1, data_key)]), lambda token: token),
+    ):
+        tokens = [store(token) for token in encrypt_many(values, cipher, workers=0)]
+        results.append({
+            'format': name,
+            'bytes': len(tokens[0]),
+            'encrypt': _rate(1, lambda i: [store(token) for token in encrypt_many(values, cipher, workers=0)]) * count,
+            'decrypt': _rate(1, lambda i: decrypt_many(tokens, cipher, workers=0)) * count,
+        })
+    return results
@@ -0,0 +1,37 @@
+# Per-Request Query Counting using Observer Pattern
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryCounter:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Subscribe to every SQL statement the app executes and report the
+        per-request total in the X-Query-Count response header.
+        :param app: The Flask application
+        """
+        if not event.contains(Engine, 'before_cursor_execute', _count_query):
+            event.listen(Engine, 'before_cursor_execute', _count_query)
+        app.after_request(self._report)
+
+    @staticmethod
+    def current():
+        """
+        Number of statements executed so far in the current request.
+        """
+        return g.get('query_count', 0)
+
+    def _report(self, response):
+        count = self.current()
+        response.headers['X-Query-Count'] = str(count)
+        return response
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
@@ -0,0 +1,262 @@
+# Password Hashing using a Process Pool
+import json
+import multiprocessing
+import os
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingUnavailable(Exception):
+    """Raised when the hashing queue stays full for longer than the queue timeout."""
+
+
+class PasswordHasher:
+    """
+    Runs the deliberately slow password KDFs in a pool of worker processes,
+    so a request thread waits on a future instead of burning CPU under the
+    GIL, and concurrent logins spread over every core. The number of hashes
+    queued or running is bounded; with workers = 0 hashing runs inline.
+    """
+
+    def __init__(self, app=None, workers=0, max_queue=64, queue_timeout=5.0, method=None):
+        self.workers = workers
+        self.method = method  # werkzeug method string, e.g. 'scrypt:65536:8:1'; None uses werkzeug's default
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._pool = None
+        self._background = None
+        self._prefix = None  # (method, the prefix werkzeug writes for it)
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._latencies = deque(maxlen=1024)  # Seconds from submit to result, most recent hashes
+        self._pending = 0  # Queue slots held: hashes queued or running
+        self._max_pending = 0
+        self._completed = 0
+        self._inline = 0
+        self._rejected = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Read HASH_POOL_WORKERS (0 hashes inline), HASH_POOL_MAX_QUEUE,
+        HASH_POOL_QUEUE_TIMEOUT and PASSWORD_HASH_METHOD, falling back to the
+        method saved by `flask calibrate-hash`. The pool starts on first use.
+        :param app: The Flask application
+        """
+        self.workers = app.config.get('HASH_POOL_WORKERS', self.workers)
+        self.max_queue = app.config.get('HASH_POOL_MAX_QUEUE', self.max_queue)
+        self.queue_timeout = app.config.get('HASH_POOL_QUEUE_TIMEOUT', self.queue_timeout)
+        self.method = app.config.get('PASSWORD_HASH_METHOD') or load_hash_method(hash_params_path(app), app.logger)
+
+    def generate(self, password):
+        return self._run(generate_password_hash, password, self._method())
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def generate_many(self, passwords):
+        """
+        Hash several values at once, e.g. a password and its security
+        answers, in parallel on the pool.
+        :param passwords: Sequence of plaintext values
+        """
+        return self._run_many(generate_password_hash, [(password, self._method()) for password in passwords])
+
+    def check_many(self, pairs):
+        """
+        Verify several (hash, value) pairs in parallel on the pool.
+        :param pairs: Sequence of (stored hash, plaintext) tuples
+        """
+        return self._run_many(check_password_hash, pairs)
+
+    def needs_rehash(self, pwhash):
+        # True if pwhash was made with other parameters than the configured ones
+        return self.method is not None and pwhash.split('$', 1)[0] != self._method_prefix()
+
+    def _method_prefix(self):
+        # werkzeug expands shorthand such as 'scrypt' to 'scrypt:32768:8:1' in
+        # the stored hash, so compare against a real hash's prefix. Made on
+        # first use rather than in init_app, which every pool worker runs too.
+        # The hash runs outside the lock, which also guards the hashing queue
+        method, prefix = self.method, self._prefix
+        if prefix is None or prefix[0] != method:
+            prefix = (method, generate_password_hash('', method).split('$', 1)[0])
+            with self._lock:
+                self._prefix = prefix
+        return prefix[1]
+
+    def background(self, func, *args):
+        """
+        Run func(*args) on a single background thread, e.g. to rehash a
+        password after the login response has been sent.
+        """
+        with self._lock:
+            if self._background is None:
+                self._background = ThreadPoolExecutor(1, thread_name_prefix='rehash')
+            return self._background.submit(func, *args)
+
+    def _method(self):
+        return self.method or 'scrypt'
+
+    def _run(self, func, *args):
+        return self._run_many(func, [args])[0]
+
+    def _run_many(self, func, calls):
+        if not self.workers:
+            with self._lock:
+                self._inline += len(calls)
+            if len(calls) == 1:
+                return [func(*calls[0])]
+            # hashlib's scrypt and pbkdf2 release the GIL, so threads still overlap
+            with ThreadPoolExecutor(len(calls)) as threads:
+                return list(threads.map(lambda args: func(*args), calls))
+
+        # A batch takes all of its slots in one step. Taking them one at a
+        # time lets concurrent batches each hold a part and wait for the
+        # rest until they all time out. A batch larger than the whole queue
+        # waits for an empty queue.
+        slots = min(len(calls), self.max_queue)
+        with self._slot_freed:
+            if not self._slot_freed.wait_for(lambda: self._pending + slots <= self.max_queue,
+                                             timeout=self.queue_timeout):
+                self._rejected += 1
+                raise HashingUnavailable("Too many password hashes queued.")
+            self._pending += slots
+            self._max_pending = max(self._max_pending, self._pending)
+
+        try:
+            start = time.perf_counter()
+            try:
+                futures = [self._executor().submit(func, *args) for args in calls]
+                results = [future.result() for future in futures]
+            except BrokenProcessPool:
+                # A worker died (e.g. killed by the OS); start a fresh pool next time
+                self._reset()
+                with self._lock:
+                    self._inline += len(calls)
+                results = [func(*args) for args in calls]
+            latency = time.perf_counter() - start
+            with self._lock:
+                self._completed += len(calls)
+                self._latencies.extend([latency] * len(calls))
+            return results
+        finally:
+            with self._slot_freed:
+                self._pending -= slots
+                self._slot_freed.notify_all()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn: forking a process that runs request threads is unsafe
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _reset(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                'workers': self.workers,
+                'queue_depth': self._pending,
+                'max_queue_depth': self._max_pending,
+                'max_queue': self.max_queue,
+                'completed': self._completed,
+                'inline': self._inline,
+                'rejected': self._rejected,
+                'latency_ms_avg': round(1000 * sum(latencies) / len(latencies), 1) if latencies else None,
+                'latency_ms_p95': round(1000 * latencies[int(len(latencies) * 0.95)], 1) if latencies else None,
+            }
+
+
+def hash_params_path(app):
+    return os.path.join(app.instance_path, 'password_hash.json')
+
+
+def load_hash_method(path, logger=None):
+    """
+    The method saved by `flask calibrate-hash`, or None for werkzeug's
+    default if there is none or the file cannot be used.
+    :param path: Path of password_hash.json
+    :param logger: Where to report an unusable file
+    """
+    try:
+        with open(path, encoding='utf-8') as params:
+            method = json.load(params)['method']
+        if not isinstance(method, str):
+            raise ValueError(f"method is {method!r}")
+        return method
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError) as e:
+        if logger is not None:
+            logger.warning("Ignoring unusable password hash settings in %s (%s); using the default method", path, e)
+        return None
+
+
+def save_hash_method(path, method, milliseconds):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as params:
+        json.dump({'method': method, 'ms': round(milliseconds, 1)}, params)
+
+
+def _time_hash(method, rounds=3):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        generate_password_hash('calibration password', method)
+        timings.append(1000 * (time.perf_counter() - start))
+    return statistics.median(timings)
+
+
+def calibrate(algorithm='scrypt', target_ms=150, progress=None):
+    """
+    Find the strongest cost setting whose hash takes at most target_ms on
+    this host, timing one hash at a time the way a pool worker runs it.
+    Returns (werkzeug method string, milliseconds per hash).
+    :param algorithm: 'scrypt' (memory-hard) or 'pbkdf2' (sha256)
+    :param target_ms: Latency budget for one hash
+    :param progress: Optional callable(method, milliseconds) for every setting tried
+    """
+    if algorithm == 'scrypt':
+        # Double N (memory and time) from 2**14 until the budget runs out; r=8, p=1
+        best = None
+        for log_n in range(14, 21):
+            method = f'scrypt:{2 ** log_n}:8:1'
+            ms = _time_hash(method)
+            if progress:
+                progress(method, ms)
+            if ms > target_ms:
+                break
+            best = (method, ms)
+        return best or (method, ms)
+
+    if algorithm == 'pbkdf2':
+        # Time is linear in iterations: extrapolate from a probe, then step back until it fits
+        probe = 100000
+        iterations = max(10000, int(probe * target_ms / _time_hash(f'pbkdf2:sha256:{probe}')) // 10000 * 10000)
+        while True:
+            method = f'pbkdf2:sha256:{iterations}'
+            ms = _time_hash(method)
+            if progress:
+                progress(method, ms)
+            if ms <= target_ms or iterations <= 10000:
+                return method, ms
+            iterations -= 10000
+
+    raise ValueError(f"Unknown hash algorithm {algorithm!r}.")
+
+
+# Shared by the models and the routes; configured by app.py
+password_hasher = PasswordHasher()
@@ -0,0 +1,375 @@
+# Key Management using a Key Hierarchy
+import base64
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from sqlalchemy import select, update, bindparam
+from models import db, DataKey, VaultItem, VaultDetail, configure_crypto, encrypt_many, decrypt_many
+
+
+# Envelope encryption: every vault item has its own random data key,
+# stored in vault_items.wrapped_key encrypted under the owner's newest
+# user data key. Rotating a user's key only rewraps one small key per item.
+#
+# Encrypted under a user data key (wrapped item keys, and detail values
+# written before items had keys):
+#   format 1 | user data key id (4, big endian) | nonce (12) | AES-256-GCM ciphertext and tag
+# Encrypted under an item key (detail values):
+#   format 2 | nonce (12) | AES-256-GCM ciphertext and tag
+# The header is authenticated as associated data. Values written before
+# either format are Fernet tokens (base64 text) and are still decrypted.
+FORMAT_V1 = 1
+FORMAT_V2 = 2
+HEADER = struct.Struct('>BI')
+ITEM_HEADER = bytes([FORMAT_V2])
+NONCE_SIZE = 12
+TAG_SIZE = 16
+MIN_TOKEN_SIZE = HEADER.size + NONCE_SIZE + TAG_SIZE
+
+
+def is_user_key_format(token):
+    return isinstance(token, bytes) and len(token) >= MIN_TOKEN_SIZE and token[0] == FORMAT_V1
+
+
+def is_item_key_format(token):
+    return isinstance(token, bytes) and len(token) >= len(ITEM_HEADER) + NONCE_SIZE + TAG_SIZE and token[0] == FORMAT_V2
+
+
+def _aead_key(data_key):
+    # Derive the AES key from the data key rather than reusing its bytes,
+    # which also serve as the Fernet key for legacy tokens
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                info=b'vault-details/aes-gcm/v1').derive(base64.urlsafe_b64decode(data_key))
+
+
+class ItemCipher:
+    """
+    Encrypts one item's detail values under the item's own key. Values
+    written under the user's key are still decrypted through it.
+    """
+
+    def __init__(self, item_key, user_cipher):
+        self._aead = AESGCM(item_key)
+        self._user_cipher = user_cipher
+
+    def encrypt(self, data):
+        nonce = os.urandom(NONCE_SIZE)
+        return ITEM_HEADER + nonce + self._aead.encrypt(nonce, data, ITEM_HEADER)
+
+    def decrypt(self, token):
+        if not is_item_key_format(token):
+            return self._user_cipher.decrypt(token)
+        start = len(ITEM_HEADER)
+        try:
+            return self._aead.decrypt(token[start:start + NONCE_SIZE], token[start + NONCE_SIZE:], ITEM_HEADER)
+        except InvalidTag:
+            raise InvalidToken from None
+
+
+class VaultCipher:
+    """
+    Encrypts with the newest of a user's data keys and decrypts with the
+    key each value names. Same encrypt/decrypt interface as Fernet.
+    """
+
+    def __init__(self, keys, load_key=None):
+        """
+        :param keys: (data key id, unwrapped data key) pairs, newest first
+        :param load_key: Optional callable(key_id) returning a data key this
+                         cipher was built without, e.g. one added by a rotation
+        """
+        self.key_id = keys[0][0]
+        self._load_key = load_key
+        self._aeads = {key_id: AESGCM(_aead_key(data_key)) for key_id, data_key in keys}
+        self._fernet = MultiFernet([Fernet(data_key) for _, data_key in keys])
+
+    def encrypt(self, data):
+        header = HEADER.pack(FORMAT_V1, self.key_id)
+        nonce = os.urandom(NONCE_SIZE)
+        return header + nonce + self._aeads[self.key_id].encrypt(nonce, data, header)
+
+    def new_item_key(self):
+        # A fresh item key: its cipher, and the wrapped form to store on the item
+        item_key = AESGCM.generate_key(bit_length=256)
+        return ItemCipher(item_key, self), self.encrypt(item_key)
+
+    def item_cipher(self, wrapped_key):
+        """
+        Cipher for one item's detail values.
+        :param wrapped_key: vault_items.wrapped_key; None for items created
+                            before items had keys, whose values use this cipher
+        """
+        if wrapped_key is None:
+            return self
+        return ItemCipher(self.decrypt(wrapped_key), self)
+
+    def is_current(self, token):
+        # True if token is encrypted under this cipher's newest key
+        return is_user_key_format(token) and HEADER.unpack_from(token)[1] == self.key_id
+
+    def decrypt(self, token):
+        if not is_user_key_format(token):
+            return self._fernet.decrypt(token)
+        _, key_id = HEADER.unpack_from(token)
+        aead = self._aeads.get(key_id)
+        if aead is None:
+            data_key = self._load_key(key_id) if self._load_key else None
+            if data_key is None:
+                raise InvalidToken
+            aead = self._aeads[key_id] = AESGCM(_aead_key(data_key))
+        try:
+            return aead.decrypt(token[HEADER.size:HEADER.size + NONCE_SIZE],
+                                token[HEADER.size + NONCE_SIZE:], token[:HEADER.size])
+        except InvalidTag:
+            raise InvalidToken from None
+
+
+class KeyManager:
+    """
+    Two-level key hierarchy for vault secrets.
+
+    A single key-encrypting key (KEK) is persisted outside the database and
+    shared by every worker process. Each user has a random data key stored
+    in data_keys wrapped (encrypted) by the KEK. Unwrapping is one symmetric
+    decrypt, with no KDF, so any worker can rebuild a user's cipher from the
+    database, and unwrapped ciphers are cached per session.
+    """
+
+    def __init__(self, app=None, cache_size=1024, cache_ttl=300):
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._kek = None
+        self._kek_source = None  # (VAULT_KEK, key file path); the KEK is read on first use
+        self._cache = OrderedDict()  # session id -> (user_id, cipher, loaded_at)
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Take the KEK from VAULT_KEK, or from VAULT_KEK_PATH (created with
+        owner-only permissions when missing). It is loaded on first use, so
+        processes that import the app without serving it never touch it.
+        :param app: The Flask application
+        """
+        self._kek = None
+        self._kek_source = (app.config.get('VAULT_KEK'),
+                            app.config.get('VAULT_KEK_PATH') or os.path.join(app.instance_path, 'vault.kek'))
+        self.cache_size = app.config.get('VAULT_KEY_CACHE_SIZE', self.cache_size)
+        self.cache_ttl = app.config.get('VAULT_KEY_CACHE_TTL', self.cache_ttl)
+        configure_crypto(app.config.get('VAULT_CRYPTO_WORKERS', 0), app.config.get('VAULT_CRYPTO_MIN_BATCH', 512))
+
+    def create_data_key(self, user_id):
+        """
+        Generate a new data key for a user and store it wrapped by the KEK.
+        Added to the current transaction; the caller commits.
+        :param user_id: Owner of the key
+        """
+        data_key = DataKey(user_id=user_id, wrapped_key=self._key_encryption_key().encrypt(Fernet.generate_key()).decode('ascii'))
+        db.session.add(data_key)
+        return data_key
+
+    def user_cipher(self, user_id):
+        """
+        Build the cipher for a user straight from the database, creating the
+        user's first data key if there is none yet. A new key is only
+        flushed; the caller commits it with the rest of its transaction.
+        The newest key encrypts; every key of the user can decrypt.
+        :param user_id: Owner of the keys
+        """
+        keys = DataKey.query.filter_by(user_id=user_id).order_by(DataKey.id.desc()).all()
+        if not keys:
+            keys = [self.create_data_key(user_id)]
+            db.session.flush()
+        return VaultCipher([(key.id, self._unwrap(key)) for key in keys],
+                           load_key=lambda key_id: self._load_key(user_id, key_id))
+
+    def _unwrap(self, data_key):
+        return self._key_encryption_key().decrypt(data_key.wrapped_key.encode('ascii'))
+
+    def _key_encryption_key(self):
+        with self._lock:
+            if self._kek is None:
+                kek, path = self._kek_source
+                self._kek = Fernet(kek or load_or_create_key_file(path))
+            return self._kek
+
+    def _load_key(self, user_id, key_id):
+        data_key = DataKey.query.filter_by(id=key_id, user_id=user_id).first()
+        return self._unwrap(data_key) if data_key else None
+
+    def unlock(self, session_id, user_id):
+        """
+        Unwrap a user's data key once, at login, and cache it for the session.
+        A first data key is only flushed; the caller commits it before the
+        session encrypts anything with it.
+        :param session_id: Identifier of the login session
+        :param user_id: Logged-in user
+        """
+        cipher = self.user_cipher(user_id)
+        with self._lock:
+            self._cache[session_id] = (user_id, cipher, time.monotonic())
+            self._cache.move_to_end(session_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return cipher
+
+    def session_cipher(self, session_id, user_id):
+        """
+        Cipher for a logged-in session. Served from memory when this worker
+        has seen the session recently, otherwise unwrapped again from the
+        database, so it does not matter which worker serves the request.
+        :param session_id: Identifier of the login session
+        :param user_id: Logged-in user
+        """
+        with self._lock:
+            entry = self._cache.get(session_id)
+            if entry and entry[0] == user_id and time.monotonic() - entry[2] < self.cache_ttl:
+                self._cache.move_to_end(session_id)
+                return entry[1]
+        return self.unlock(session_id, user_id)
+
+    def forget(self, session_id):
+        with self._lock:
+            self._cache.pop(session_id, None)
+
+    def clear(self):
+        # Drop every cached cipher, e.g. after new data keys were added
+        with self._lock:
+            self._cache.clear()
+
+    def rewrite_batch(self, after_id, batch_size=500):
+        """
+        Bring the next batch of vault items after after_id up to date: item
+        keys wrapped under an older user key are rewrapped under the newest
+        one, which leaves their detail values untouched. Items created
+        before items had keys get one, and their details are re-encrypted
+        under it in the same transaction. Every UPDATE is guarded on the
+        old value, so concurrent edits win. Runs in the caller's
+        transaction. Returns (last id read, items read, items rewritten).
+        :param after_id: Keyset position; 0 starts from the beginning
+        :param batch_size: Items read per call
+        """
+        items = db.session.execute(
+            select(VaultItem.id, VaultItem.user_id, VaultItem.wrapped_key)
+            .where(VaultItem.id > after_id)
+            .order_by(VaultItem.id).limit(batch_size)
+        ).all()
+        if not items:
+            return after_id, 0, 0
+
+        by_user = {}
+        for item in items:
+            by_user.setdefault(item.user_id, []).append(item)
+        rewraps, legacy = [], []
+        for user_id, user_items in by_user.items():
+            cipher = self.user_cipher(user_id)
+            for item in user_items:
+                if item.wrapped_key is None:
+                    legacy.append((item, cipher))
+                elif not cipher.is_current(item.wrapped_key):
+                    rewraps.append({'item_id': item.id, 'old': item.wrapped_key,
+                                    'new': cipher.encrypt(cipher.decrypt(item.wrapped_key))})
+
+        rewritten = 0
+        if rewraps:
+            rewritten += db.session.execute(
+                update(VaultItem.__table__)
+                .where(VaultItem.id == bindparam('item_id'), VaultItem.wrapped_key == bindparam('old'))
+                .values(wrapped_key=bindparam('new')),
+                rewraps,
+            ).rowcount
+        for item, cipher in legacy:
+            rewritten += self._add_item_key(item.id, cipher)
+        return items[-1].id, len(items), rewritten
+
+    def _add_item_key(self, item_id, cipher):
+        # Give an item created before items had keys its own key and move its values under it
+        item_cipher, wrapped_key = cipher.new_item_key()
+        if not db.session.execute(
+            update(VaultItem.__table__)
+            .where(VaultItem.id == item_id, VaultItem.wrapped_key.is_(None))
+            .values(wrapped_key=wrapped_key)
+        ).rowcount:
+            return 0  # Edited meanwhile; the edit gave it a key
+        details = db.session.execute(
+            select(VaultDetail.id, VaultDetail.value).where(VaultDetail.vault_item_id == item_id)
+        ).all()
+        tokens = encrypt_many(decrypt_many([d.value for d in details], cipher), item_cipher)
+        if details:
+            # Old values are bound as-is: legacy rows may hold text, not bytes
+            db.session.execute(
+                update(VaultDetail.__table__)
+                .where(VaultDetail.id == bindparam('row_id'),
+                       VaultDetail.value == bindparam('old', type_=db.String))
+                .values(value=bindparam('new')),
+                [{'row_id': d.id, 'old': d.value, 'new': token} for d, token in zip(details, tokens)],
+            )
+        return 1
+
+    def migrate_values(self, batch_size=500, progress=None):
+        """
+        Give every item created before items had keys its own key, and
+        rewrap item keys still under an older user key, one short
+        transaction per batch, so the app keeps serving while it runs.
+        Safe to stop and rerun. Returns (migrated, scanned) in items.
+        :param batch_size: Items read and committed per transaction
+        :param progress: Optional callable(migrated, scanned, rows_per_sec)
+        """
+        migrated, scanned, last_id = 0, 0, 0
+        start = time.perf_counter()
+        while True:
+            last_id, read, rewritten = self.rewrite_batch(last_id, batch_size)
+            db.session.commit()
+            if not read:
+                break
+            migrated += rewritten
+            scanned += read
+            if progress:
+                progress(migrated, scanned, scanned / (time.perf_counter() - start))
+        return migrated, scanned
+
+def load_or_create_key_file(path):
+    """
+    Read a Fernet key from path, creating it if it does not exist. The key
+    is written and synced under a temporary name and then hard-linked into
+    place, which fails if another worker got there first, so every worker
+    only ever sees a complete key and they all end up with the same one.
+    :param path: Location of the key file
+    """
+    try:
+        return _read_key_file(path)
+    except FileNotFoundError:
+        pass
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.vault-key.', dir=directory)  # Created with mode 0600
+    try:
+        with os.fdopen(fd, 'wb') as key_file:
+            key_file.write(Fernet.generate_key())
+            key_file.flush()
+            os.fsync(key_file.fileno())
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass  # Another worker won the race; use its key
+    finally:
+        os.unlink(tmp_path)
+    return _read_key_file(path)
+
+def _read_key_file(path):
+    with open(path, 'rb') as key_file:
+        key = key_file.read().strip()
+    try:
+        Fernet(key)
+    except ValueError:
+        raise ValueError(f"{path} does not hold a valid key; restore it from backup.") from None
+    return key
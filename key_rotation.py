@@ -0,0 +1,241 @@
+# Key Rotation using a Resumable Batch Job
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, func, or_
+from key_manager import HEADER, FORMAT_V1, FORMAT_V2
+from models import db, DataKey, KeyRotation, VaultItem, VaultDetail
+
+
+RotationProgress = namedtuple('RotationProgress', ['scanned', 'rewritten', 'remaining', 'rows_per_sec', 'eta_seconds'])
+
+
+def unfinished_rotation():
+    return KeyRotation.query.filter(KeyRotation.finished_at.is_(None)).order_by(KeyRotation.id).first()
+
+
+def start_rotation(key_manager):
+    """
+    Give every user a new data key and record a checkpoint, in one
+    transaction. From then on new item keys are wrapped under the new user
+    keys, while the old ones stay readable until every item is rewrapped.
+    Returns the unfinished rotation instead if one is already in progress.
+    :param key_manager: KeyManager creating the keys
+    """
+    rotation = unfinished_rotation()
+    if rotation:
+        return rotation
+    previous = rotation_to_retire()
+    if previous:
+        retire_keys(key_manager, previous)
+    for user_id in db.session.scalars(select(DataKey.user_id).distinct()).all():
+        key_manager.create_data_key(user_id)
+    rotation = KeyRotation()
+    db.session.add(rotation)
+    db.session.commit()
+    # Sessions served by other processes pick up the new keys once their
+    # cached ciphers expire (VAULT_KEY_CACHE_TTL)
+    key_manager.clear()
+    return rotation
+
+
+def rotation_to_retire():
+    # The latest finished rotation whose superseded keys are still stored
+    return (KeyRotation.query.filter(KeyRotation.finished_at.isnot(None), KeyRotation.keys_retired_at.is_(None))
+            .order_by(KeyRotation.id.desc()).first())
+
+
+def seconds_until_retirable(key_manager, rotation):
+    # Ciphers cached before the rotation started still encrypt under the old
+    # keys until VAULT_KEY_CACHE_TTL has passed
+    ready_at = rotation.started_at + timedelta(seconds=key_manager.cache_ttl)
+    return max(0.0, (ready_at - datetime.utcnow()).total_seconds())
+
+
+def _key_ids(prefixes):
+    # Data key ids named by the format 1 headers among the given value prefixes
+    return {HEADER.unpack(prefix)[1] for prefix in prefixes
+            if isinstance(prefix, bytes) and len(prefix) == HEADER.size and prefix[0] == FORMAT_V1}
+
+
+def retire_keys(key_manager, rotation):
+    """
+    Delete the data keys a finished rotation superseded. A user's newest
+    key always stays, and so does any key still named by a wrapped item
+    key or by a value written under a user key. Users with values from
+    before the binary formats keep every key, since a Fernet token does
+    not say which key made it. Commits. Returns the number of keys
+    deleted, or None if cached ciphers may still use the old keys.
+    :param key_manager: KeyManager whose cached ciphers are dropped afterwards
+    :param rotation: Finished KeyRotation
+    """
+    if rotation.finished_at is None or seconds_until_retirable(key_manager, rotation) > 0:
+        return None
+
+    # One pass over the item keys and one over the details, reading only
+    # the header of each value
+    in_use = _key_ids(db.session.scalars(
+        select(func.substr(VaultItem.wrapped_key, 1, HEADER.size)).distinct()
+        .where(VaultItem.wrapped_key.isnot(None))))
+    in_use |= _key_ids(db.session.scalars(
+        select(func.substr(VaultDetail.value, 1, HEADER.size)).distinct()
+        .where(func.substr(VaultDetail.value, 1, 1) == bytes([FORMAT_V1]))))
+    legacy_users = db.session.scalars(
+        select(VaultItem.user_id).distinct().join(VaultDetail, VaultDetail.vault_item_id == VaultItem.id)
+        .where(func.substr(VaultDetail.value, 1, 1).notin_([bytes([FORMAT_V1]), bytes([FORMAT_V2])]))).all()
+    newest = select(func.max(DataKey.id)).group_by(DataKey.user_id)
+
+    retired = db.session.execute(
+        delete(DataKey)
+        .where(DataKey.id.notin_(newest), DataKey.id.notin_(in_use), DataKey.user_id.notin_(legacy_users))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    rotation.keys_retired_at = datetime.utcnow()
+    db.session.commit()
+    key_manager.clear()
+    return retired
+
+
+class RotationJob:
+    """
+    Rewraps item keys under the newest user keys, in item id order, one
+    batch per transaction. Detail values are encrypted under the item keys
+    and are not touched. The checkpoint moves forward in the same
+    transaction as the items it covers, so a crash loses at most the batch
+    in flight, and a rerun continues from last_item_id.
+    """
+
+    def __init__(self, key_manager, rotation_id, batch_size=500, max_rows_per_sec=0,
+                 lease_seconds=60, progress=None, stop=None):
+        """
+        :param key_manager: KeyManager providing ciphers and rewrite_batch
+        :param rotation_id: Checkpoint row to run
+        :param batch_size: Items read and committed per transaction
+        :param max_rows_per_sec: Throttle to leave room for live traffic; 0 runs flat out
+        :param lease_seconds: Heartbeat age after which another process may take over
+        :param progress: Optional callable(RotationProgress) after every batch
+        :param stop: Optional threading.Event that ends the run after the current batch
+        """
+        self.key_manager = key_manager
+        self.rotation_id = rotation_id
+        self.batch_size = batch_size
+        self.max_rows_per_sec = max_rows_per_sec
+        self.lease_seconds = lease_seconds
+        self.progress = progress
+        self.stop = stop or threading.Event()
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+    def claim(self):
+        # Take the lease unless another live process holds it
+        now = datetime.utcnow()
+        claimed = db.session.execute(
+            update(KeyRotation)
+            .where(KeyRotation.id == self.rotation_id, KeyRotation.finished_at.is_(None),
+                   or_(KeyRotation.owner.is_(None), KeyRotation.owner == self.owner,
+                       KeyRotation.heartbeat_at < now - timedelta(seconds=self.lease_seconds)))
+            .values(owner=self.owner, heartbeat_at=now)
+        ).rowcount
+        db.session.commit()
+        return claimed == 1
+
+    def _checkpoint(self, **values):
+        # Advance the checkpoint only while still holding the lease
+        return db.session.execute(
+            update(KeyRotation)
+            .where(KeyRotation.id == self.rotation_id, KeyRotation.owner == self.owner)
+            .values(heartbeat_at=datetime.utcnow(), **values)
+        ).rowcount == 1
+
+    def run(self):
+        """
+        Run the rotation until it is done, stopped or its lease is lost.
+        Returns True when every item has been visited.
+        """
+        if not self.claim():
+            return False
+        rotation = db.session.get(KeyRotation, self.rotation_id)
+        last_id = rotation.last_item_id
+        total = db.session.scalar(select(func.count()).select_from(VaultItem).where(VaultItem.id > last_id))
+        scanned = 0
+        start = time.perf_counter()
+
+        while not self.stop.is_set():
+            batch_start = time.perf_counter()
+            last_id, read, rewritten = self.key_manager.rewrite_batch(last_id, self.batch_size)
+            if not read:
+                break
+            if not self._checkpoint(last_item_id=last_id, items_rewritten=KeyRotation.items_rewritten + rewritten):
+                db.session.rollback()
+                return False
+            db.session.commit()
+
+            scanned += read
+            rate = scanned / (time.perf_counter() - start)
+            if self.progress:
+                remaining = max(total - scanned, 0)
+                self.progress(RotationProgress(scanned, rewritten, remaining, rate, remaining / rate))
+            if self.max_rows_per_sec:
+                time.sleep(max(0, read / self.max_rows_per_sec - (time.perf_counter() - batch_start)))
+        else:
+            # Stopped: hand the lease back so the next run starts right away
+            self._checkpoint(owner=None)
+            db.session.commit()
+            return False
+
+        self._checkpoint(owner=None, finished_at=datetime.utcnow())
+        db.session.commit()
+        return True
+
+
+class RotationWorker(threading.Thread):
+    """
+    Background thread that picks up unfinished rotations, e.g. ones
+    started with `flask rotate-keys --detach`, and runs them throttled.
+    """
+
+    def __init__(self, app, key_manager, interval=30):
+        super().__init__(name='key-rotation', daemon=True)
+        self.app = app
+        self.key_manager = key_manager
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    rotation = unfinished_rotation()
+                    if rotation:
+                        RotationJob(self.key_manager, rotation.id,
+                                    batch_size=self.app.config['VAULT_ROTATION_BATCH_SIZE'],
+                                    max_rows_per_sec=self.app.config['VAULT_ROTATION_MAX_ROWS_PER_SEC'],
+                                    stop=self.stop_event).run()
+                    rotation = rotation_to_retire()
+                    if rotation:
+                        retire_keys(self.key_manager, rotation)
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception("Key rotation batch failed; retrying later")
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def rotation_status():
+    # Progress of the latest rotation for /metrics
+    rotation = KeyRotation.query.order_by(KeyRotation.id.desc()).first()
+    if rotation is None:
+        return None
+    return {
+        'id': rotation.id,
+        'started_at': rotation.started_at.isoformat(),
+        'finished_at': rotation.finished_at.isoformat() if rotation.finished_at else None,
+        'last_item_id': rotation.last_item_id,
+        'items_rewritten': rotation.items_rewritten,
+        'keys_retired_at': rotation.keys_retired_at.isoformat() if rotation.keys_retired_at else None,
+    }
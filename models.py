@@ -1,71 +1,196 @@
+import sqlite3
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, event
+from sqlalchemy.engine import Engine
 from datetime import datetime
-from cryptography.fernet import Fernet
-from werkzeug.security import generate_password_hash, check_password_hash
+from cryptography.fernet import InvalidToken
+from hashing import password_hasher
 
 db = SQLAlchemy()
 
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores FOREIGN KEY clauses, ON DELETE CASCADE included, unless
+    # every connection turns enforcement on
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys = ON')
+        cursor.close()
+
 class User(db.Model):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
     email = Column(String(120), unique=True, nullable=False)
     password_hash = Column(String(128), nullable=False)
+    vault_version = Column(Integer, nullable=False, default=0, server_default='0')  # Bumped on every vault write
+    vault_updated_at = Column(db.DateTime)  # Time of the last vault write
     security_questions = db.relationship('SecurityQuestion', backref='user', lazy=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.generate(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.check(self.password_hash, password)
 
 class SecurityQuestion(db.Model):
     __tablename__ = 'security_questions'
     id = db.Column(db.Integer, primary_key=True)
     question = db.Column(db.String(255), nullable=False)
     answer_hash = db.Column(db.String(128), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    # False for answers hashed as typed, before answers were normalized
+    answer_normalized = db.Column(db.Boolean, nullable=False, default=True)
 
     def set_answer(self, answer):
-        self.answer_hash = generate_password_hash(answer)
+        self.answer_hash = password_hasher.generate(self.normalize_answer(answer))
+        self.answer_normalized = True
 
     def check_answer(self, answer):
-        return check_password_hash(self.answer_hash, answer)
+        if password_hasher.check(self.answer_hash, self.normalize_answer(answer)):
+            return True
+        return not self.answer_normalized and password_hasher.check(self.answer_hash, answer)
+
+    @staticmethod
+    def normalize_answer(answer):
+        # "  New   York" and "new york" are the same answer
+        return ' '.join(unicodedata.normalize('NFKC', answer).casefold().split())
 
 
 class VaultItem(db.Model):
     __tablename__ = 'vault_items'
+    __table_args__ = (
+        db.Index('ix_vault_items_user_id_name', 'user_id', 'name'),  # Serves the (name, id) keyset pages
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     item_type = db.Column(db.String(50), nullable=False)  # 'Login', 'Credit Card', 'Identity', 'Secure Note'
     name = db.Column(db.String(120), nullable=False)  # Friendly name for the item
-    details = db.relationship('VaultDetail', backref='vault_item', lazy=True)
+    details = db.relationship('VaultDetail', backref='vault_item', lazy=True, passive_deletes=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, onupdate=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Optimistic concurrency token
+    wrapped_key = db.Column(db.LargeBinary)  # The item's data key, encrypted under the owner's key (see key_manager)
+
+    # Every ORM UPDATE of an item checks and bumps version in its WHERE clause
+    __mapper_args__ = {'version_id_col': version}
 
 class VaultDetail(db.Model):
     __tablename__ = 'vault_details'
     id = db.Column(db.Integer, primary_key=True)
-    vault_item_id = db.Column(db.Integer, db.ForeignKey('vault_items.id'), nullable=False)
+    vault_item_id = db.Column(db.Integer, db.ForeignKey('vault_items.id', ondelete='CASCADE'), nullable=False, index=True)
     key = db.Column(db.String(120), nullable=False)  # Example: 'username', 'password', 'credit_card_number'
-    value = db.Column(db.String(255), nullable=False)  # Sensitive data encrypted before storage
+    value = db.Column(db.LargeBinary, nullable=False)  # Sensitive data encrypted before storage (see key_manager)
+
+    def set_value(self, value, cipher):
+        self.value = encrypt_data(value, cipher)
 
-    def set_value(self, value):
-        self.value = encrypt_data(value)
+    def get_value(self, cipher):
+        return decrypt_data(self.value, cipher)
 
-    def get_value(self):
-        return decrypt_data(self.value)
+class DataKey(db.Model):
+    __tablename__ = 'data_keys'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    wrapped_key = db.Column(db.String(255), nullable=False)  # Data key encrypted under the key-encrypting key
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class KeyRotation(db.Model):
+    __tablename__ = 'key_rotation_checkpoints'
+    id = db.Column(db.Integer, primary_key=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)  # NULL while the rotation is in progress
+    last_item_id = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Keyset position of the last committed batch
+    items_rewritten = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    owner = db.Column(db.String(64))  # Process currently running the job
+    heartbeat_at = db.Column(db.DateTime)  # Lease: another process may take over once this is stale
+    keys_retired_at = db.Column(db.DateTime)  # When the data keys this rotation superseded were deleted
 
-# Replace with a secure key management approach
-SECRET_KEY = Fernet.generate_key()
-cipher = Fernet(SECRET_KEY)
+class ServerSessionRecord(db.Model):
+    __tablename__ = 'server_sessions'
+    id = db.Column(db.String(64), primary_key=True)  # Random session id, the only thing in the cookie
+    user_id = db.Column(db.Integer, index=True)  # Logged-in user, NULL before login
+    data = db.Column(db.Text, nullable=False)  # Session values as tagged JSON
+    expires_at = db.Column(db.Float, nullable=False, index=True)  # Unix time; slides forward while the session is used
 
-def encrypt_data(data):
-    if isinstance(data, str):
-        data = data.encode('utf-8')
-    return cipher.encrypt(data).decode('utf-8')
 
-def decrypt_data(data):
+def encrypt_data(data, cipher):
     if isinstance(data, str):
         data = data.encode('utf-8')
-    return cipher.decrypt(data).decode('utf-8')
+    return cipher.encrypt(data)
+
+def decrypt_data(data, cipher):
+    try:
+        return cipher.decrypt(data).decode('utf-8')
+    except InvalidToken:
+        # Rows written before values were encrypted hold the plain value as text
+        if isinstance(data, str):
+            return data
+        raise
+
+
+# Batches of at least min_batch values are split across `workers` threads;
+# the AES and HMAC work runs in OpenSSL with the GIL released
+_crypto = {'workers': 0, 'min_batch': 512}
+_crypto_pools = {}
+_crypto_lock = threading.Lock()
+
+def configure_crypto(workers=0, min_batch=512):
+    _crypto.update(workers=workers, min_batch=min_batch)
+
+def _crypto_pool(workers):
+    with _crypto_lock:
+        pool = _crypto_pools.get(workers)
+        if pool is None:
+            pool = _crypto_pools[workers] = ThreadPoolExecutor(workers, thread_name_prefix='vault-crypto')
+        return pool
+
+def _fan_out(run, values, workers):
+    if workers is None:
+        workers = _crypto['workers']
+    if workers <= 1 or len(values) < _crypto['min_batch']:
+        return run(values)
+    size = -(-len(values) // workers)
+    chunks = [values[i:i + size] for i in range(0, len(values), size)]
+    return [value for chunk in _crypto_pool(workers).map(run, chunks) for value in chunk]
+
+def encrypt_many(values, cipher, workers=None):
+    """
+    Encrypt a batch of values with one cipher, returning tokens in order.
+    :param values: Sequence of str or bytes
+    :param cipher: The owner's data key cipher
+    :param workers: Threads for large batches; None uses the configured count
+    """
+    encrypt = cipher.encrypt
+
+    def run(chunk):
+        return [encrypt(value.encode('utf-8') if isinstance(value, str) else value) for value in chunk]
+
+    return _fan_out(run, list(values), workers)
+
+def decrypt_many(tokens, cipher, workers=None):
+    """
+    Decrypt a batch of stored values with one cipher, returning str in order.
+    Tokens are handed to the cipher as stored, without copying.
+    :param tokens: Sequence of stored values
+    :param cipher: The owner's data key cipher
+    :param workers: Threads for large batches; None uses the configured count
+    """
+    decrypt = cipher.decrypt
+
+    def run(chunk):
+        values = []
+        for token in chunk:
+            try:
+                values.append(decrypt(token).decode('utf-8'))
+            except InvalidToken:
+                # Rows written before values were encrypted hold the plain value as text
+                if not isinstance(token, str):
+                    raise
+                values.append(token)
+        return values
+
+    return _fan_out(run, list(tokens), workers)
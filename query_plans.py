@@ -0,0 +1,73 @@
+# Query Plan Regression Checks for the app's hot queries
+from sqlalchemy import text
+from models import db, User, SecurityQuestion, VaultItem, VaultDetail, DataKey
+from vault_repository import VaultRepository, encode_cursor
+from vault_search import SEARCH_SQL, build_match_query
+
+
+class _Key:
+    # Stand-in for the last item of a page when building a cursor
+    name = 'example'
+    id = 1
+
+
+def hot_queries():
+    """
+    Yield (label, SQL, params) for every query a request path relies on.
+    Statements are built by the same code the routes use wherever it is
+    shared, so a change to that code is checked automatically.
+    """
+    repository = VaultRepository()
+    cursor = encode_cursor(_Key())
+
+    yield 'login: user by email', User.query.filter_by(email='user@example.com').statement, None
+    yield 'vault: revision lookup', (db.session.query(User.vault_version, User.vault_updated_at)
+                                     .filter_by(id=1).statement), None
+    yield 'vault: first page', repository.page_query(1).statement, None
+    yield 'vault: later page', repository.page_query(1, cursor=cursor).statement, None
+    yield 'vault: page details', VaultDetail.query.filter(VaultDetail.vault_item_id.in_([1, 2])).statement, None
+    yield 'vault: stream', repository.iter_items(1).statement, None
+    yield 'api: page rows', repository.item_rows_statement(1, cursor=cursor), None
+    yield 'api: item rows', repository.item_rows_statement(1, item_id=1), None
+    yield 'modify/delete: item by id and owner', VaultItem.query.filter_by(id=1, user_id=1).statement, None
+    yield 'delete: details by item', VaultDetail.query.filter_by(vault_item_id=1).statement, None
+    yield 'keys: data keys by user', DataKey.query.filter_by(user_id=1).order_by(DataKey.id.desc()).statement, None
+    yield 'recovery: security questions', SecurityQuestion.query.filter_by(user_id=1).statement, None
+    yield 'search: ranked matches', text(SEARCH_SQL), {
+        'match': build_match_query('example'), 'user_id': 1, 'limit': 21, 'offset': 0,
+    }
+
+
+def explain(statement, params=None):
+    """
+    Return the EXPLAIN QUERY PLAN detail lines for a statement.
+    :param statement: SQLAlchemy statement or text clause
+    :param params: Bind parameters for a text clause
+    """
+    if params is None:
+        sql = str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    else:
+        sql = statement.text
+    rows = db.session.execute(text('EXPLAIN QUERY PLAN ' + sql), params or {})
+    return [row[-1] for row in rows]
+
+
+def full_scans(plan):
+    """
+    Plan lines that walk a whole table or index instead of seeking into it.
+    Scans of subqueries and of the FTS virtual table are expected.
+    :param plan: Detail lines from explain()
+    """
+    tables = set(db.metadata.tables)
+    return [line for line in plan
+            if line.startswith('SCAN ') and line.split()[1] in tables]
+
+
+def check_query_plans():
+    """
+    Explain every hot query and collect the ones that degraded to a scan.
+    Returns a list of (label, plan, offending lines) for every query.
+    """
+    return [(label, plan, full_scans(plan))
+            for label, statement, params in hot_queries()
+            for plan in [explain(statement, params)]]
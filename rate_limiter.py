@@ -0,0 +1,222 @@
+# Admission Control using Token Buckets
+import atexit
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from flask import request
+
+
+class AdmissionRejected(Exception):
+    """Raised before any hashing when a request is over its limits."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Too many attempts; retry in {retry_after} seconds.")
+        self.retry_after = retry_after
+
+
+class TokenBucketLimiter:
+    """
+    One token bucket per key, refilled continuously at rate tokens per
+    second up to burst. Buckets live in an LRU-ordered dict capped at
+    max_keys, so lookups and evictions are O(1) and memory is bounded.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, last refill as wall-clock time]
+        self._lock = threading.Lock()
+
+    def take(self, key, now=None):
+        """
+        Take one token from key's bucket. Returns 0 if one was available,
+        otherwise the seconds until one will be.
+        :param key: e.g. an IP address or an email
+        """
+        now = now or time.time()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / self.rate
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def dump(self):
+        with self._lock:
+            return [[key, tokens, updated] for key, (tokens, updated) in self._buckets.items()]
+
+    def merge(self, buckets, now=None):
+        """
+        Fold in buckets saved by another process. Where both know a key the
+        lower token count wins, so limits hold across workers; full buckets
+        carry no information and are skipped.
+        :param buckets: [key, tokens, last refill] entries as returned by dump
+        """
+        now = now or time.time()
+        with self._lock:
+            for key, tokens, updated in buckets[-self.max_keys:]:
+                tokens = min(self.burst, tokens + max(0, now - updated) * self.rate)
+                if tokens >= self.burst:
+                    continue
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    self._buckets[key] = [tokens, now]
+                    if len(self._buckets) > self.max_keys:
+                        self._buckets.popitem(last=False)
+                else:
+                    bucket[0] = min(tokens, self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                    bucket[1] = now
+
+
+class AdmissionControl:
+    """
+    Admission control for routes that run password KDFs: per-IP and
+    per-account token buckets, plus a cap on requests hashing at once.
+    Rejected requests fail fast with 429 before any hashing starts.
+    Bucket state is saved periodically so a restart does not reset limits.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.by_ip = TokenBucketLimiter(rate=20 / 60, burst=20)
+        self.by_account = TokenBucketLimiter(rate=5 / 60, burst=10)
+        self._hashing = threading.BoundedSemaphore(32)
+        self._state_path = None
+        self._save_interval = 0
+        self._logger = None
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._rejected = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Read the RATE_LIMIT_* settings and restore saved bucket state.
+        :param app: The Flask application
+        """
+        config = app.config
+        self.enabled = config.get('RATE_LIMIT_ENABLED', True)
+        self.by_ip = TokenBucketLimiter(config['RATE_LIMIT_IP_PER_MINUTE'] / 60, config['RATE_LIMIT_IP_BURST'],
+                                        config['RATE_LIMIT_MAX_KEYS'])
+        self.by_account = TokenBucketLimiter(config['RATE_LIMIT_ACCOUNT_PER_MINUTE'] / 60,
+                                             config['RATE_LIMIT_ACCOUNT_BURST'], config['RATE_LIMIT_MAX_KEYS'])
+        self._hashing = threading.BoundedSemaphore(config['RATE_LIMIT_MAX_CONCURRENT_HASHING'])
+        self._state_path = config.get('RATE_LIMIT_STATE_PATH') or os.path.join(app.instance_path, 'rate_limits.json')
+        self._save_interval = config.get('RATE_LIMIT_SAVE_INTERVAL', 30)
+        self._logger = app.logger
+        self.restore()
+
+    def start(self):
+        # Save the bucket state every RATE_LIMIT_SAVE_INTERVAL seconds and at
+        # exit; called once by the serving process
+        if self.enabled and self._save_interval:
+            threading.Thread(target=self._save_every, args=(self._save_interval,), name='rate-limit-save',
+                             daemon=True).start()
+            atexit.register(self.save)
+
+    def guard(self, account=None):
+        """
+        Decorator for views that hash on POST.
+        :param account: Optional callable returning the account the request
+                        targets; defaults to the submitted email
+        """
+        account = account or (lambda: request.form.get('email', '').strip().lower() or None)
+
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapped(*args, **kwargs):
+                if not self.enabled or request.method != 'POST':
+                    return view(*args, **kwargs)
+                self.admit(request.remote_addr, account())
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    self._hashing.release()
+            return wrapped
+        return decorator
+
+    def admit(self, ip, account=None):
+        """
+        Take a token for the IP and the account, then a hashing slot,
+        without waiting for any of them. The caller releases the slot.
+        Raises AdmissionRejected if the request is over a limit.
+        """
+        wait = self.by_ip.take(f'ip:{ip}')
+        if not wait and account:
+            wait = self.by_account.take(f'account:{account}')
+        if not wait and not self._hashing.acquire(blocking=False):
+            wait = 1
+        with self._lock:
+            if wait:
+                self._rejected += 1
+            else:
+                self._admitted += 1
+        if wait:
+            raise AdmissionRejected(max(1, round(wait)))
+
+    def save(self):
+        """
+        Merge the saved state of other workers into ours, then replace the
+        file through a temp file of this process's own.
+        """
+        if not self._state_path:
+            return
+        self.restore()
+        state = {'ip': self.by_ip.dump(), 'account': self.by_account.dump()}
+        directory = os.path.dirname(self._state_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='rate_limits.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as out:
+                json.dump(state, out)
+            os.replace(tmp_path, self._state_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def restore(self):
+        try:
+            with open(self._state_path, encoding='utf-8') as saved:
+                state = json.load(saved)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            # Not expected now that writes are atomic; start over rather than fail
+            self._logger.warning("Ignoring unreadable rate limit state in %s", self._state_path)
+            return
+        self.by_ip.merge(state.get('ip', []))
+        self.by_account.merge(state.get('account', []))
+
+    def _save_every(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.save()
+            except OSError:
+                pass  # Try again next interval; limits still hold in memory
+
+    def stats(self):
+        with self._lock:
+            return {
+                'admitted': self._admitted,
+                'rejected': self._rejected,
+                'tracked_ips': len(self.by_ip),
+                'tracked_accounts': len(self.by_account),
+            }
@@ -1,4 +1,7 @@
 # Master Password Recovery using Chain of Responsibility
+from hashing import password_hasher
+from models import SecurityQuestion
+
 class RecoveryHandler:
     def __init__(self):
         self.chain = None
@@ -23,12 +26,32 @@ class SecurityQuestionHandler:
         self.next_handler = None
 
     def handle(self, user, user_answers):
-        # Retrieve security questions and answers from the user relationship
-        security_answers = {q.question: q.answer.lower() for q in user.security_questions}
-
-        for answer, question in zip(user_answers, security_answers.keys()):
-            if answer.lower() != security_answers[question]:
-                return False
+        """
+        Verify every answer against its stored hash, all at once on the
+        hashing pool. Every answer is checked even after a mismatch, so the
+        response time does not tell which answer was wrong.
+        :param user: User recovering their account
+        :param user_answers: Answers in the order the questions were asked
+        """
+        questions = sorted(user.security_questions, key=lambda q: q.id)
+        user_answers = list(user_answers) + [''] * (len(questions) - len(user_answers))
+
+        # Answers stored before normalization were hashed as typed, so only
+        # those are also checked as typed. Every answer of the same kind gets
+        # the same number of checks, whether or not it matches.
+        checks, spans = [], []
+        for question, answer in zip(questions, user_answers):
+            answer = answer or ''
+            start = len(checks)
+            checks.append((question.answer_hash, SecurityQuestion.normalize_answer(answer)))
+            if not question.answer_normalized:
+                checks.append((question.answer_hash, answer))
+            spans.append((start, len(checks)))
+        results = password_hasher.check_many(checks)
+        matched = [any(results[start:end]) for start, end in spans]
+
+        if not questions or not all(matched):
+            return False
 
         if self.next_handler:
             return self.next_handler.handle(user, user_answers)
@@ -0,0 +1,87 @@
+# Schema Upgrades for databases created by older versions of the app
+from sqlalchemy import inspect, text, LargeBinary
+from models import db, VaultDetail, KeyRotation
+from vault_search import install_search_index
+
+
+# (table, column, DDL) for every column added after the first release
+ADDED_COLUMNS = [
+    ('users', 'vault_version', "INTEGER NOT NULL DEFAULT 0"),
+    ('users', 'vault_updated_at', "DATETIME"),
+    ('vault_items', 'version', "INTEGER NOT NULL DEFAULT 1"),
+    ('vault_items', 'wrapped_key', "BLOB"),
+    ('key_rotation_checkpoints', 'keys_retired_at', "DATETIME"),
+    # Rows that predate the column hold answers hashed as typed
+    ('security_questions', 'answer_normalized', "BOOLEAN NOT NULL DEFAULT 0"),
+]
+
+# (index, table, columns) for every secondary index added after the first release
+ADDED_INDEXES = [
+    ('ix_vault_items_user_id_name', 'vault_items', 'user_id, name'),
+    ('ix_vault_details_vault_item_id', 'vault_details', 'vault_item_id'),
+    ('ix_security_questions_user_id', 'security_questions', 'user_id'),
+]
+
+
+def upgrade_schema():
+    """
+    Bring an existing database up to date with models.py.
+    Every step checks the live schema first, so running it twice is safe.
+    """
+    db.create_all()  # Tables added after the first release
+
+    inspector = inspect(db.engine)
+    for table, column, ddl in ADDED_COLUMNS:
+        existing = {c['name'] for c in inspector.get_columns(table)}
+        if column not in existing:
+            db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+    for index, table, columns in ADDED_INDEXES:
+        db.session.execute(text(f'CREATE INDEX IF NOT EXISTS {index} ON {table} ({columns})'))
+
+    # Detail values moved from VARCHAR(255) to a binary column; SQLite keeps
+    # the stored values as they are, and migrate-secrets rewrites them
+    if (not _cascades(inspector, 'vault_details', 'vault_items')
+            or not _column_is(inspector, 'vault_details', 'value', LargeBinary)):
+        _rebuild_table(inspector, VaultDetail.__table__)
+
+    # Rotations used to walk vault_details; they now walk vault_items, so
+    # an unfinished one restarts from the first item
+    if any(c['name'] == 'last_detail_id' for c in inspector.get_columns('key_rotation_checkpoints')):
+        _rebuild_table(inspector, KeyRotation.__table__)
+
+    install_search_index(db.session)
+    db.session.commit()
+
+
+def _cascades(inspector, table, referred_table):
+    return any(fk['referred_table'] == referred_table and
+               (fk.get('options') or {}).get('ondelete', '').upper() == 'CASCADE'
+               for fk in inspector.get_foreign_keys(table))
+
+
+def _column_is(inspector, table, column, type_class):
+    return any(c['name'] == column and isinstance(c['type'], type_class) for c in inspector.get_columns(table))
+
+
+def _rebuild_table(inspector, table):
+    # SQLite cannot alter a foreign key or column type in place: rename the old table,
+    # create the new definition, copy the rows over and drop the old one.
+    # Rows whose parent no longer exists are left behind.
+    old_name = f'{table.name}_old'
+    old_columns = {c['name'] for c in inspector.get_columns(table.name)}
+    columns = ', '.join(f'"{c.name}"' for c in table.columns if c.name in old_columns)
+    parents = ' AND '.join(
+        f'"{fk.parent.name}" IN (SELECT "{fk.column.name}" FROM {fk.column.table.name})'
+        for fk in table.foreign_keys
+    ) or '1'
+
+    old_indexes = [index['name'] for index in inspector.get_indexes(table.name)]
+
+    db.session.execute(text(f'ALTER TABLE {table.name} RENAME TO {old_name}'))
+    for index in old_indexes:
+        db.session.execute(text(f'DROP INDEX IF EXISTS {index}'))
+    table.create(bind=db.session.connection())
+    db.session.execute(text(
+        f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old_name} WHERE {parents}'))
+    db.session.execute(text(f'DROP TABLE {old_name}'))
@@ -0,0 +1,125 @@
+# Test Fixtures: the app on a scratch SQLite database
+import itertools
+import os
+import sys
+import tempfile
+import pytest
+
+# Settings must be in the environment before app.py is imported; it reads
+# FLASK_<KEY> overrides once, at import
+_scratch = tempfile.mkdtemp(prefix='vault-tests-')
+os.environ.update({
+    'FLASK_SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(_scratch, 'test.db')}",
+    'FLASK_VAULT_KEK_PATH': os.path.join(_scratch, 'vault.kek'),
+    'FLASK_RATE_LIMIT_ENABLED': 'false',
+    'FLASK_RATE_LIMIT_STATE_PATH': os.path.join(_scratch, 'rate_limits.json'),
+    'FLASK_HASH_POOL_WORKERS': '0',  # Hash inline; no process pool in tests
+    'FLASK_PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',  # Cheap on purpose
+    'FLASK_SESSION_REAP_INTERVAL': '0',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+from app import app as flask_app  # noqa: E402
+from models import db, User, VaultItem  # noqa: E402
+from schema import upgrade_schema  # noqa: E402
+
+_emails = (f'user{n}@example.com' for n in itertools.count(1))
+
+ITEM_FIELDS = [(f'field{n}', f'value{n}') for n in range(30)]
+
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        upgrade_schema()
+    return flask_app
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield
+        db.session.remove()
+
+
+def _register(client, email, password='password', answers=('Rex', 'Smith', 'Detroit')):
+    return client.post('/register', data={
+        'email': email, 'password': password, 'confirm_password': password,
+        'security_answer_1': answers[0], 'security_answer_2': answers[1], 'security_answer_3': answers[2],
+    })
+
+
+@pytest.fixture
+def register():
+    # register(client, email, password='password', answers=(...)) signs a user up
+    return _register
+
+
+@pytest.fixture
+def email():
+    # Every test gets its own user; the database is shared by the session
+    return next(_emails)
+
+
+@pytest.fixture
+def client(app, email):
+    # A test client logged in as a freshly registered user
+    client = app.test_client()
+    _register(client, email)
+    response = client.post('/login', data={'email': email, 'password': 'password'})
+    assert response.headers['Location'].endswith('/vault')
+    return client
+
+
+@pytest.fixture
+def item_fields():
+    # The 30 detail fields create_item gives an item by default
+    return list(ITEM_FIELDS)
+
+
+@pytest.fixture
+def create_item(app):
+    """
+    create_item(client, email, fields=ITEM_FIELDS) adds a Login item through
+    the vault form and returns its (id, version).
+    """
+    def create(client, email, fields=ITEM_FIELDS):
+        client.post('/vault', data={'item_type': 'Login', 'name': 'Bank',
+                                    'detail_key': [key for key, _ in fields],
+                                    'detail_value': [value for _, value in fields]})
+        with app.app_context():
+            item = (VaultItem.query.join(User).filter(User.email == email)
+                    .order_by(VaultItem.id.desc()).first())
+            return item.id, item.version
+    return create
+
+
+@pytest.fixture
+def save_item():
+    # save_item(client, item_id, version, fields, name='Bank') posts the edit form
+    def save(client, item_id, version, fields, name='Bank'):
+        return client.post(f'/modify_item/{item_id}', data={
+            'item_type': 'Login', 'name': name, 'version': version,
+            'detail_key': [key for key, _ in fields], 'detail_value': [value for _, value in fields],
+        })
+    return save
+
+
+@pytest.fixture
+def statements(app):
+    """
+    List that collects the SQL of every statement executed while the test
+    runs.
+    """
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    yield executed
+    event.remove(engine, 'before_cursor_execute', record)
@@ -0,0 +1,66 @@
+# Encrypted Vault Export Tests
+import io
+import json
+import pytest
+from vault_export import HEADER_SIZE, encrypt_stream, decrypt_stream
+
+
+def export(client, passphrase):
+    response = client.post('/vault/export', data={'passphrase': passphrase, 'confirm_passphrase': passphrase})
+    data = response.get_data()
+    response.close()
+    assert response.status_code == 200
+    return data
+
+
+def decrypt(data, passphrase):
+    return b''.join(decrypt_stream(io.BytesIO(data), passphrase))
+
+
+def test_export_round_trip(client):
+    for name, pin in [('Bank', '1234'), ('Mail', 'ünïcode')]:
+        client.post('/vault', data={'item_type': 'Login', 'name': name, 'detail_key': 'pin', 'detail_value': pin})
+
+    data = export(client, 'correct horse')
+
+    assert b'Bank' not in data
+    items = [json.loads(line) for line in decrypt(data, 'correct horse').decode('utf-8').splitlines()]
+    assert [(item['name'], item['details']) for item in items] == [
+        ('Bank', [{'key': 'pin', 'value': '1234'}]), ('Mail', [{'key': 'pin', 'value': 'ünïcode'}])]
+
+
+def test_export_without_passphrase_is_plain(client):
+    client.post('/vault', data={'item_type': 'Login', 'name': 'Bank', 'detail_key': 'pin', 'detail_value': '1234'})
+    assert json.loads(export(client, ''))['name'] == 'Bank'
+
+
+def test_wrong_passphrase_is_rejected(client):
+    data = export(client, 'correct horse')
+    with pytest.raises(ValueError, match='Wrong passphrase'):
+        decrypt(data, 'battery staple')
+
+
+@pytest.fixture(scope='module')
+def container():
+    # Three frames, so truncation can fall between frames as well as inside one
+    return b''.join(encrypt_stream([b'first\n', b'second\n', b'third\n'], 'pw'))
+
+
+def test_container_round_trip(container):
+    assert decrypt(container, 'pw') == b'first\nsecond\nthird\n'
+
+
+@pytest.mark.parametrize('cut', [
+    lambda data: data[:HEADER_SIZE],  # No frames at all
+    lambda data: data[:HEADER_SIZE + 2],  # Inside a frame length
+    lambda data: data[:-5],  # Inside the last frame
+    lambda data: data[:len(data) - (4 + 16 + len(b'third\n'))],  # Whole last frame dropped
+])
+def test_truncated_container_is_rejected(container, cut):
+    with pytest.raises(ValueError):
+        decrypt(cut(container), 'pw')
+
+
+def test_not_a_container():
+    with pytest.raises(ValueError, match='Not an encrypted vault export'):
+        decrypt(b'{"name": "Bank"}\n', 'pw')
@@ -0,0 +1,82 @@
+# Password Hashing Pool Tests
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from hashing import PasswordHasher, HashingUnavailable, load_hash_method, save_hash_method
+
+
+def slow_hash(value):
+    time.sleep(0.2)
+    return value.upper()
+
+
+@pytest.fixture
+def hasher(monkeypatch):
+    # Queue accounting as with a process pool, but on threads so the test
+    # needs no worker processes
+    hasher = PasswordHasher(workers=12, max_queue=6, queue_timeout=2.0)
+    executor = ThreadPoolExecutor(12)
+    monkeypatch.setattr(hasher, '_executor', lambda: executor)
+    yield hasher
+    executor.shutdown()
+
+
+def run_concurrently(batches, hasher):
+    start = threading.Barrier(len(batches))
+    results = [None] * len(batches)
+
+    def run(n, batch):
+        start.wait()
+        try:
+            results[n] = hasher._run_many(slow_hash, [(value,) for value in batch])
+        except HashingUnavailable as e:
+            results[n] = e
+
+    threads = [threading.Thread(target=run, args=(n, batch)) for n, batch in enumerate(batches)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_batches_over_the_queue_size_take_turns(hasher):
+    # Three batches of 4 against 6 slots: they must run one after another,
+    # not each grab part of the slots and all time out
+    batches = [[f'{n}{i}' for i in range(4)] for n in range(3)]
+
+    results = run_concurrently(batches, hasher)
+
+    assert results == [[value.upper() for value in batch] for batch in batches]
+    assert hasher.stats()['rejected'] == 0
+    assert hasher.stats()['max_queue_depth'] <= 6
+    assert hasher.stats()['queue_depth'] == 0
+
+
+def test_batch_larger_than_the_queue_still_runs(hasher):
+    assert hasher._run_many(slow_hash, [(str(n),) for n in range(8)]) == [str(n) for n in range(8)]
+
+
+def test_full_queue_times_out(hasher):
+    hasher.queue_timeout = 0.05
+    results = run_concurrently([['a'] * 6, ['b']], hasher)
+    assert sum(isinstance(result, HashingUnavailable) for result in results) == 1
+    assert hasher.stats()['rejected'] == 1
+
+
+@pytest.mark.parametrize('content', ['{"method": "scrypt:16384:8', '{"ms": 150}', '["scrypt"]', '{"method": 5}'])
+def test_unusable_saved_method_falls_back_to_the_default(tmp_path, caplog, content):
+    path = tmp_path / 'password_hash.json'
+    path.write_text(content)
+    with caplog.at_level('WARNING'):
+        assert load_hash_method(path, logging.getLogger('test')) is None
+    assert 'Ignoring unusable password hash settings' in caplog.text
+
+
+def test_saved_method_is_loaded(tmp_path):
+    path = tmp_path / 'instance' / 'password_hash.json'
+    assert load_hash_method(path) is None
+    save_hash_method(path, 'scrypt:16384:8:1', 120)
+    assert load_hash_method(path) == 'scrypt:16384:8:1'
@@ -0,0 +1,101 @@
+# Key Rotation Tests
+from sqlalchemy import text
+from app import key_manager
+from key_rotation import RotationJob, start_rotation, retire_keys
+from models import db, User, VaultItem, DataKey, KeyRotation
+
+
+def legacy_item(app, register, email):
+    # A user who never logged in, with an item from before data keys existed
+    register(app.test_client(), email)
+    with app.app_context():
+        user = User.query.filter_by(email=email).first()
+        item = VaultItem(user_id=user.id, item_type='Login', name='Legacy')
+        db.session.add(item)
+        db.session.flush()
+        # Values stored before encryption hold the plain text
+        db.session.execute(text("INSERT INTO vault_details (vault_item_id, key, value) VALUES (:id, 'password', 'plain')"),
+                           {'id': item.id})
+        db.session.commit()
+        return user.id, item.id
+
+
+def test_rewrite_batch_leaves_commit_to_the_caller(app, register, email):
+    user_id, item_id = legacy_item(app, register, email)
+    with app.app_context():
+        key_manager.rewrite_batch(item_id - 1, batch_size=1)
+        db.session.rollback()  # e.g. the job lost its lease
+
+        assert DataKey.query.filter_by(user_id=user_id).count() == 0
+        assert db.session.get(VaultItem, item_id).wrapped_key is None
+
+        key_manager.rewrite_batch(item_id - 1, batch_size=1)
+        db.session.commit()
+
+        assert DataKey.query.filter_by(user_id=user_id).count() == 1
+        item = db.session.get(VaultItem, item_id)
+        cipher = key_manager.user_cipher(user_id).item_cipher(item.wrapped_key)
+        assert cipher.decrypt(item.details[0].value) == b'plain'
+
+
+def test_unlock_leaves_commit_to_the_caller(app, register, email):
+    register(app.test_client(), email)
+    with app.app_context():
+        user_id = User.query.filter_by(email=email).first().id
+        key_manager.unlock('unlock-test', user_id)
+        db.session.rollback()
+        assert DataKey.query.filter_by(user_id=user_id).count() == 0
+    key_manager.forget('unlock-test')
+
+
+def test_login_stores_the_first_data_key(app, client, email):
+    with app.app_context():
+        user_id = User.query.filter_by(email=email).first().id
+        assert DataKey.query.filter_by(user_id=user_id).count() == 1
+
+
+def rotate(app, monkeypatch):
+    # Start and finish a rotation, with no cached ciphers left to wait for
+    monkeypatch.setattr(key_manager, 'cache_ttl', 0)
+    with app.app_context():
+        rotation = start_rotation(key_manager)
+        assert RotationJob(key_manager, rotation.id).run()
+        return rotation.id
+
+
+def test_finished_rotation_retires_superseded_keys(app, client, email, monkeypatch):
+    client.post('/vault', data={'item_type': 'Login', 'name': 'Bank', 'detail_key': 'pin', 'detail_value': '1234'})
+    rotation_id = rotate(app, monkeypatch)
+    rotate(app, monkeypatch)  # Retires what the first one superseded before adding new keys
+
+    with app.app_context():
+        retire_keys(key_manager, db.session.get(KeyRotation, rotation_id + 1))
+        user = User.query.filter_by(email=email).first()
+        assert DataKey.query.filter_by(user_id=user.id).count() == 1
+        assert db.session.get(KeyRotation, rotation_id).keys_retired_at is not None
+    assert b'1234' in client.get('/vault').data
+
+
+def test_keys_still_in_use_are_kept(app, client, email, monkeypatch):
+    with app.app_context():
+        user_id = User.query.filter_by(email=email).first().id
+        old_cipher = key_manager.user_cipher(user_id)
+    rotation_id = rotate(app, monkeypatch)
+
+    with app.app_context():
+        # An item key wrapped by a process that still had the old key cached
+        item = VaultItem(user_id=user_id, item_type='Login', name='Late', wrapped_key=old_cipher.new_item_key()[1])
+        db.session.add(item)
+        db.session.commit()
+
+        assert retire_keys(key_manager, db.session.get(KeyRotation, rotation_id)) is not None
+        assert DataKey.query.filter_by(user_id=user_id).count() == 2
+
+
+def test_retiring_waits_for_cached_ciphers(app, client, monkeypatch):
+    rotation_id = rotate(app, monkeypatch)
+    monkeypatch.setattr(key_manager, 'cache_ttl', 300)
+    with app.app_context():
+        rotation = db.session.get(KeyRotation, rotation_id)
+        assert retire_keys(key_manager, rotation) is None
+        assert rotation.keys_retired_at is None
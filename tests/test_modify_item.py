@@ -0,0 +1,45 @@
+# Diff-Based Item Editing Tests
+from models import db, VaultItem
+
+
+def writes_to(statements, table):
+    return [s.split()[0] for s in statements
+            if s.startswith(('INSERT', 'UPDATE', 'DELETE')) and f' {table} ' in f'{s} ']
+
+
+def test_one_changed_field_is_one_update(app, client, email, statements, item_fields, create_item, save_item):
+    item_id, version = create_item(client, email)
+    item_fields[17] = ('field17', 'changed')
+
+    del statements[:]
+    response = save_item(client, item_id, version, item_fields)
+
+    assert response.status_code == 302
+    assert writes_to(statements, 'vault_details') == ['UPDATE']
+    with app.app_context():
+        item = db.session.get(VaultItem, item_id)
+        assert len(item.details) == 30
+        assert item.version == version + 1
+        assert item.updated_at is not None
+
+
+def test_added_and_removed_fields_touch_only_those_rows(client, email, statements, item_fields, create_item, save_item):
+    item_id, version = create_item(client, email)
+    fields = item_fields[1:] + [('pin', '1234')]
+
+    del statements[:]
+    save_item(client, item_id, version, fields)
+
+    assert sorted(writes_to(statements, 'vault_details')) == ['DELETE', 'INSERT']
+
+
+def test_unchanged_item_writes_nothing(app, client, email, statements, item_fields, create_item, save_item):
+    item_id, version = create_item(client, email)
+
+    del statements[:]
+    save_item(client, item_id, version, item_fields)
+
+    assert not writes_to(statements, 'vault_details')
+    assert not writes_to(statements, 'vault_items')
+    with app.app_context():
+        assert db.session.get(VaultItem, item_id).version == version
@@ -0,0 +1,17 @@
+# Query Plan Regression Tests
+from query_plans import hot_queries, explain, full_scans
+
+
+def test_hot_queries_never_scan_a_table(app_context):
+    # Every query a request path relies on must seek into an index
+    degraded = {}
+    for label, statement, params in hot_queries():
+        plan = explain(statement, params)
+        if full_scans(plan):
+            degraded[label] = plan
+    assert not degraded
+
+
+def test_full_scans_flags_table_scans(app_context):
+    plan = ['SCAN vault_items', 'SCAN anon_1', 'SEARCH vault_details USING INDEX ix_vault_details_vault_item_id']
+    assert full_scans(plan) == ['SCAN vault_items']
@@ -0,0 +1,103 @@
+# Admission Control Tests
+import json
+import os
+import pytest
+from flask import Flask
+from app import admission_control
+from rate_limiter import AdmissionControl, AdmissionRejected, TokenBucketLimiter
+
+
+def test_bucket_allows_a_burst_then_refills():
+    limiter = TokenBucketLimiter(rate=1, burst=3)
+    assert [limiter.take('k', now=100) for _ in range(3)] == [0, 0, 0]
+    assert limiter.take('k', now=100) == pytest.approx(1)
+    assert limiter.take('k', now=101.5) == 0
+
+
+def test_merge_keeps_the_lower_token_count():
+    ours, theirs = TokenBucketLimiter(rate=1, burst=10), TokenBucketLimiter(rate=1, burst=10)
+    for _ in range(3):
+        ours.take('a', now=100)
+    for _ in range(8):
+        theirs.take('a', now=100)
+    theirs.take('b', now=100)
+
+    ours.merge(theirs.dump(), now=100)
+    theirs.merge(ours.dump(), now=100)
+
+    assert dict((key, tokens) for key, tokens, _ in ours.dump()) == {'a': 2, 'b': 9}
+    assert dict((key, tokens) for key, tokens, _ in theirs.dump())['a'] == 2
+
+
+def test_merge_refills_saved_buckets_and_skips_full_ones():
+    limiter = TokenBucketLimiter(rate=1, burst=10)
+    limiter.merge([['old', 0, 90], ['new', 4, 100]], now=100)  # 'old' has refilled to full since
+    assert [key for key, _, _ in limiter.dump()] == ['new']
+
+
+@pytest.fixture
+def control(tmp_path):
+    app = Flask(__name__)
+    app.config.update(RATE_LIMIT_IP_PER_MINUTE=60, RATE_LIMIT_IP_BURST=5, RATE_LIMIT_ACCOUNT_PER_MINUTE=60,
+                      RATE_LIMIT_ACCOUNT_BURST=2, RATE_LIMIT_MAX_KEYS=100, RATE_LIMIT_MAX_CONCURRENT_HASHING=1,
+                      RATE_LIMIT_STATE_PATH=str(tmp_path / 'state' / 'rate_limits.json'))
+    return AdmissionControl(app)
+
+
+def test_account_limit_holds_across_ips(control):
+    control.admit('10.0.0.1', 'a@b.c')
+    control._hashing.release()
+    control.admit('10.0.0.2', 'a@b.c')
+    control._hashing.release()
+    with pytest.raises(AdmissionRejected) as rejected:
+        control.admit('10.0.0.3', 'a@b.c')
+    assert rejected.value.retry_after >= 1
+    assert control.stats()['rejected'] == 1
+
+
+def test_hashing_slots_are_capped(control):
+    control.admit('10.0.0.1')
+    with pytest.raises(AdmissionRejected):
+        control.admit('10.0.0.2')
+
+
+def test_save_replaces_the_file_atomically(control, tmp_path, monkeypatch):
+    control.by_ip.take('ip:10.0.0.1')
+    control.save()
+    path = tmp_path / 'state' / 'rate_limits.json'
+    saved = path.read_text()
+    assert json.loads(saved)['ip'][0][:2] == ['ip:10.0.0.1', 4]
+
+    def fail(*args, **kwargs):
+        raise OSError('disk full')
+    monkeypatch.setattr(json, 'dump', fail)
+    control.by_ip.take('ip:10.0.0.2')
+    with pytest.raises(OSError):
+        control.save()
+
+    assert path.read_text() == saved  # The old state is left whole
+    assert os.listdir(path.parent) == ['rate_limits.json']  # And no temp file behind
+
+
+def test_restore_merges_saved_state_and_ignores_a_broken_file(control, tmp_path):
+    control.by_account.take('account:a@b.c')
+    control.save()
+    control.by_account = TokenBucketLimiter(rate=1, burst=2)
+    control.restore()
+    assert [key for key, _, _ in control.by_account.dump()] == ['account:a@b.c']
+
+    (tmp_path / 'state' / 'rate_limits.json').write_text('{"ip": [')
+    control.restore()  # Logged and skipped
+
+
+def test_login_over_the_limit_gets_429(app, email, monkeypatch):
+    monkeypatch.setattr(admission_control, 'enabled', True)
+    monkeypatch.setattr(admission_control, 'by_ip', TokenBucketLimiter(rate=1 / 60, burst=100))
+    monkeypatch.setattr(admission_control, 'by_account', TokenBucketLimiter(rate=1 / 60, burst=2))
+    client = app.test_client()
+
+    statuses = [client.post('/login', data={'email': email, 'password': 'wrong'}).status_code for _ in range(3)]
+
+    assert statuses == [200, 200, 429]
+    response = client.post('/login', data={'email': email, 'password': 'wrong'})
+    assert int(response.headers['Retry-After']) >= 1
@@ -0,0 +1,78 @@
+# Security Answer Tests
+from werkzeug.security import check_password_hash, generate_password_hash
+from hashing import password_hasher
+from models import db, User, SecurityQuestion
+
+
+def recover(client, email, answers):
+    return client.post('/recover_password', data={
+        'email': email, 'answer1': answers[0], 'answer2': answers[1], 'answer3': answers[2],
+    })
+
+
+def test_normalize_answer():
+    assert SecurityQuestion.normalize_answer('  New \t York ') == 'new york'
+    assert SecurityQuestion.normalize_answer('ＦＬＵＦＦＹ') == 'fluffy'  # Full-width letters (NFKC)
+    assert SecurityQuestion.normalize_answer('Straße') == SecurityQuestion.normalize_answer('STRASSE')
+
+
+def test_answers_are_stored_normalized(app, email, register):
+    register(app.test_client(), email, answers=('  Fluffy ', 'New  York', 'BLUE'))
+    with app.app_context():
+        user = User.query.filter_by(email=email).first()
+        hashes = [q.answer_hash for q in sorted(user.security_questions, key=lambda q: q.id)]
+    assert [check_password_hash(h, a) for h, a in zip(hashes, ['fluffy', 'new york', 'blue'])] == [True] * 3
+
+
+def test_recovery_accepts_differently_typed_answers(app, email, register):
+    client = app.test_client()
+    register(client, email, answers=('  Fluffy ', 'New  York', 'BLUE'))
+
+    response = recover(client, email, ['fluffy', ' NEW YORK', 'Blue'])
+
+    assert '/reset_password/' in response.headers['Location']
+
+
+def test_recovery_rejects_a_wrong_answer(app, email, register):
+    client = app.test_client()
+    register(client, email, answers=('Fluffy', 'New York', 'Blue'))
+
+    response = recover(client, email, ['fluffy', 'new york', 'green'])
+
+    assert response.headers['Location'].endswith('/recover_password')
+
+
+def test_every_answer_is_checked_even_after_a_mismatch(app, email, register, monkeypatch):
+    client = app.test_client()
+    register(client, email)
+    checked = []
+    check_many = password_hasher.check_many
+    monkeypatch.setattr(password_hasher, 'check_many', lambda pairs: checked.append(len(pairs)) or check_many(pairs))
+
+    recover(client, email, ['wrong', 'wrong', 'wrong'])
+    recover(client, email, ['Rex', 'Smith', 'Detroit'])
+
+    # One check per answer, whatever the outcome
+    assert checked == [3, 3]
+
+
+def test_answers_hashed_before_normalization_still_match(app, email, register, monkeypatch):
+    client = app.test_client()
+    register(client, email)
+    with app.app_context():
+        user = User.query.filter_by(email=email).first()
+        questions = sorted(user.security_questions, key=lambda q: q.id)
+        for question, raw in zip(questions[:2], ['Smith ', 'DETROIT']):
+            question.answer_hash = generate_password_hash(raw, 'pbkdf2:sha256:1000')
+            question.answer_normalized = False
+        db.session.commit()
+    checked = []
+    check_many = password_hasher.check_many
+    monkeypatch.setattr(password_hasher, 'check_many', lambda pairs: checked.append(len(pairs)) or check_many(pairs))
+
+    response = recover(client, email, ['Smith ', 'DETROIT', 'Detroit'])
+    recover(client, email, ['wrong', 'wrong', 'wrong'])
+
+    assert '/reset_password/' in response.headers['Location']
+    # Only the two answers hashed as typed are also checked as typed
+    assert checked == [5, 5]
@@ -0,0 +1,125 @@
+# Server-Side Session Tests
+import time
+import pytest
+from flask import session
+from app import app as flask_app, session_interface
+from auth import SessionStore
+from models import db, ServerSessionRecord, User
+
+
+def test_saving_a_session_leaves_the_request_transaction_alone(app, email):
+    store = session_interface.store
+    with app.app_context():
+        db.session.add(User(email=email, password_hash='x'))
+
+        store.save('s' * 43, {'note': 'pending'})
+        store.touch('s' * 43)
+        store.delete('s' * 43)
+        db.session.rollback()
+
+        assert User.query.filter_by(email=email).first() is None
+        assert db.session.get(ServerSessionRecord, 's' * 43) is None
+
+
+def test_failed_view_does_not_block_its_session(app, email, monkeypatch):
+    def fail():
+        session['note'] = 'changed'
+        db.session.add(User(email=email, password_hash='x'))
+        db.session.flush()
+        raise RuntimeError('view failed')
+
+    monkeypatch.setitem(flask_app.view_functions, 'home', fail)
+    monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', False)
+    client = app.test_client()
+
+    assert client.get('/').status_code == 500
+    with app.app_context():
+        assert User.query.filter_by(email=email).first() is None
+        sid = client.get_cookie(app.config['SESSION_COOKIE_NAME']).value
+        assert session_interface.store.get(sid) == {'note': 'changed'}
+
+
+def session_id(client, app):
+    cookie = client.get_cookie(app.config['SESSION_COOKIE_NAME'])
+    return cookie.value if cookie else None
+
+
+def test_login_issues_a_new_session_id(app, email, register):
+    client = app.test_client()
+    register(client, email)
+    with client.session_transaction() as before:
+        before['theme'] = 'dark'
+    planted = session_id(client, app)
+
+    client.post('/login', data={'email': email, 'password': 'password'})
+
+    sid = session_id(client, app)
+    assert sid != planted
+    with app.app_context():
+        assert session_interface.store.get(planted) is None
+        assert db.session.get(ServerSessionRecord, planted) is None
+        assert session_interface.store.get(sid)['theme'] == 'dark'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+
+def stored_expiry(app, sid):
+    with app.app_context():
+        return db.session.get(ServerSessionRecord, sid).expires_at
+
+
+def test_expiry_slides_with_use(app, clock):
+    store = SessionStore(lifetime=100, revalidate_after=1000)
+    with app.app_context():
+        store.save('slide' * 9, {'user_id': 1})
+
+        clock[0] = 1050
+        assert store.get('slide' * 9) == {'user_id': 1}
+        store.touch('slide' * 9)
+        assert stored_expiry(app, 'slide' * 9) == 1150  # Stored expiry lagged by half the lifetime
+
+        clock[0] = 1055
+        store.get('slide' * 9)
+        store.touch('slide' * 9)
+        assert stored_expiry(app, 'slide' * 9) == 1150  # Too little lag to be worth a write
+
+        clock[0] = 1250
+        assert store.get('slide' * 9) is None
+
+
+def test_reap_removes_expired_sessions(app, clock):
+    store = SessionStore(lifetime=100)
+    with app.app_context():
+        store.save('reap-1' * 8, {})
+        store.save('reap-2' * 8, {})
+        clock[0] = 1050
+        store.save('reap-3' * 8, {})
+
+        clock[0] = 1105  # Past the first two, but within the grace for their rows
+        assert store.reap() == 0
+        assert len(store) == 1
+
+        clock[0] = 1155
+        assert store.reap() == 2
+        assert db.session.get(ServerSessionRecord, 'reap-3' * 8) is not None
+        store.delete('reap-3' * 8)
+
+
+def test_password_reset_ends_every_session_of_the_user(app, client, email):
+    other_device = app.test_client()
+    other_device.post('/login', data={'email': email, 'password': 'password'})
+    with app.app_context():
+        user_id = User.query.filter_by(email=email).first().id
+
+    app.test_client().post(f'/reset_password/{user_id}',
+                           data={'new_password': 'changed', 'confirm_password': 'changed'})
+
+    for device in (client, other_device):
+        assert device.get('/vault').headers['Location'].endswith('/login')
+    with app.app_context():
+        assert ServerSessionRecord.query.filter_by(user_id=user_id).count() == 0
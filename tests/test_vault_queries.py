@@ -0,0 +1,38 @@
+# Vault Read Path Query Count Tests
+import pytest
+
+
+def add_items(client, count, start=0):
+    for n in range(start, start + count):
+        client.post('/vault', data={'item_type': 'Login', 'name': f'item{n:03}',
+                                    'detail_key': ['username', 'password'], 'detail_value': ['me', 'secret']})
+
+
+def count_queries(client, path, statements):
+    # Count everything the request runs, including what a streamed body
+    # runs after the X-Query-Count header was set; reading and closing the
+    # response also pops the request context a stream keeps pushed
+    del statements[:]
+    response = client.get(path)
+    body = response.get_data()
+    response.close()
+    assert response.status_code == 200
+    return len(statements), body
+
+
+@pytest.mark.parametrize('path', ['/vault?limit=500', '/vault?stream=1', '/api/vault?limit=500'])
+def test_query_count_stays_flat_as_vault_grows(client, statements, path):
+    add_items(client, 3)
+    small, _ = count_queries(client, path, statements)
+    add_items(client, 40, start=3)
+    large, body = count_queries(client, path, statements)
+
+    assert b'item042' in body
+    assert large == small
+
+
+def test_query_count_header(client):
+    add_items(client, 5)
+    response = client.get('/vault')
+    assert response.status_code == 200
+    assert int(response.headers['X-Query-Count']) > 0
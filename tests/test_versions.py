@@ -0,0 +1,58 @@
+# Optimistic Concurrency Tests
+from models import db, VaultItem
+
+
+def test_stale_edit_gets_409_with_current_state(app, client, email, item_fields, create_item, save_item):
+    item_id, version = create_item(client, email)
+    assert save_item(client, item_id, version, item_fields, name='Saved in tab one').status_code == 302
+
+    response = save_item(client, item_id, version, item_fields, name='Saved in tab two')
+
+    assert response.status_code == 409
+    assert b'Saved in tab one' in response.data
+    with app.app_context():
+        item = db.session.get(VaultItem, item_id)
+        assert item.name == 'Saved in tab one'
+        assert item.version == version + 1
+
+
+def test_stale_edit_as_json(app, client, email, item_fields, create_item, save_item):
+    item_id, version = create_item(client, email)
+    save_item(client, item_id, version, item_fields, name='Newer')
+
+    response = client.post(f'/modify_item/{item_id}', headers={'Accept': 'application/json'},
+                           data={'item_type': 'Login', 'name': 'Older', 'version': version})
+
+    assert response.status_code == 409
+    assert response.json['current'][0]['name'] == 'Newer'
+    assert response.json['current'][0]['version'] == version + 1
+
+
+def test_stale_delete_gets_409_and_keeps_the_item(app, client, email, item_fields, create_item, save_item):
+    item_id, version = create_item(client, email)
+    save_item(client, item_id, version, item_fields, name='Edited')
+
+    assert client.post(f'/delete_item/{item_id}', data={'version': version}).status_code == 409
+    assert client.post('/delete_items', data={'item_ids': f'{item_id}:{version}'}).status_code == 409
+    with app.app_context():
+        assert db.session.get(VaultItem, item_id) is not None
+
+    assert client.post(f'/delete_item/{item_id}', data={'version': version + 1}).status_code == 302
+    with app.app_context():
+        assert db.session.get(VaultItem, item_id) is None
+
+
+def test_edit_without_version_is_rejected(client, email, create_item):
+    item_id, _ = create_item(client, email)
+    response = client.post(f'/modify_item/{item_id}', data={'item_type': 'Login', 'name': 'No version'})
+    assert response.status_code == 400
+
+
+def test_edits_to_other_items_do_not_conflict(app, client, email, item_fields, create_item, save_item):
+    first, first_version = create_item(client, email)
+    second, second_version = create_item(client, email)
+
+    assert save_item(client, first, first_version, item_fields, name='First').status_code == 302
+    assert save_item(client, second, second_version, item_fields, name='Second').status_code == 302
+    with app.app_context():
+        assert db.session.get(VaultItem, second).version == second_version + 1
@@ -0,0 +1,119 @@
+# Vault Snapshot Cache using Proxy Pattern
+import threading
+from collections import OrderedDict, namedtuple
+from models import decrypt_many
+from vault_repository import VaultPage
+
+
+ItemSnapshot = namedtuple('ItemSnapshot', ['id', 'name', 'item_type', 'version', 'details'])
+DetailSnapshot = namedtuple('DetailSnapshot', ['key', 'value'])
+
+# Rough per-object overhead used when estimating how much memory a snapshot holds
+_ITEM_OVERHEAD = 200
+_DETAIL_OVERHEAD = 120
+
+
+def snapshot_item(item, cipher):
+    """
+    Copy an ORM item into plain tuples that outlive the DB session, with
+    its detail values decrypted as one batch under the item's key.
+    :param item: VaultItem with its details loaded
+    :param cipher: The owner's data key cipher
+    """
+    values = decrypt_many([d.value for d in item.details], cipher.item_cipher(item.wrapped_key))
+    return ItemSnapshot(item.id, item.name, item.item_type, item.version,
+                        tuple(DetailSnapshot(d.key, value) for d, value in zip(item.details, values)))
+
+
+def snapshot_page(vault_page, cipher):
+    """
+    Copy a page of ORM items into snapshots.
+    :param vault_page: VaultPage holding VaultItem rows
+    :param cipher: The owner's data key cipher
+    """
+    return VaultPage(tuple(snapshot_item(item, cipher) for item in vault_page.items), vault_page.next_cursor)
+
+
+def estimate_size(vault_page):
+    size = _ITEM_OVERHEAD
+    for item in vault_page.items:
+        size += _ITEM_OVERHEAD + len(item.name) + len(item.item_type)
+        for detail in item.details:
+            size += _DETAIL_OVERHEAD + len(detail.key) + len(detail.value)
+    return size
+
+
+class VaultSnapshotCache:
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (user_id, cursor, limit) -> (version, page, size)
+        self._keys_by_user = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_load(self, key, version, loader):
+        """
+        Return the cached page for key if it was built at the given vault
+        version, otherwise build it with loader() and cache the result.
+        The version comes from the database on every request, so a write
+        made by any worker process makes older snapshots unusable here.
+        :param key: Tuple starting with the owning user's id
+        :param version: The user's current vault_version
+        :param loader: Callable returning a fresh snapshot page
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], True
+            self.misses += 1
+            if entry is not None:
+                self._remove(key)
+
+        page = loader()
+        size = estimate_size(page)
+        if size <= self.max_bytes:
+            with self._lock:
+                if key in self._entries:
+                    self._remove(key)
+                self._entries[key] = (version, page, size)
+                self._keys_by_user.setdefault(key[0], set()).add(key)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+        return page, False
+
+    def invalidate(self, user_id):
+        """
+        Drop every cached page for a user right away instead of waiting for
+        the version check to skip them.
+        :param user_id: Owner whose vault changed
+        """
+        with self._lock:
+            for key in list(self._keys_by_user.get(user_id, ())):
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+        user_keys = self._keys_by_user.get(key[0])
+        if user_keys is not None:
+            user_keys.discard(key)
+            if not user_keys:
+                del self._keys_by_user[key[0]]
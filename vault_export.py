@@ -0,0 +1,114 @@
+# Vault Export using Decorator Pattern
+import os
+import struct
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from vault_json import encode, iter_items
+
+
+EXPORT_FIELDS = ('name', 'item_type', 'details')
+
+# Encrypted container:
+#   header = MAGIC | salt (16) | nonce prefix (7)
+#   then frames of  length (4, big endian) | AES-GCM ciphertext
+# Frame nonces are prefix | frame counter (4) | last-frame flag (1), and the
+# header is authenticated with every frame, so frames cannot be reordered,
+# dropped or cut off at the end without decryption failing.
+MAGIC = b'MPEX\x01'
+SALT_SIZE = 16
+PREFIX_SIZE = 7
+HEADER_SIZE = len(MAGIC) + SALT_SIZE + PREFIX_SIZE
+FRAME_SIZE = 64 * 1024
+SCRYPT_PARAMS = {'length': 32, 'n': 2 ** 15, 'r': 8, 'p': 1}
+
+
+def export_lines(rows, cipher):
+    """
+    Encode a vault as JSON lines, one item per line, in the format the
+    importer reads back.
+    :param rows: Rows from VaultRepository.item_rows(..., limit=None)
+    :param cipher: The owner's data key cipher
+    """
+    for _, item in iter_items(rows, EXPORT_FIELDS, cipher):
+        yield encode(item) + '\n'
+
+
+def chunked(lines, size=FRAME_SIZE):
+    """
+    Group text lines into UTF-8 chunks of about size bytes each.
+    :param lines: Iterable of str
+    :param size: Target chunk size in bytes
+    """
+    buffer, length = [], 0
+    for line in lines:
+        data = line.encode('utf-8')
+        buffer.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def _derive_key(passphrase, salt):
+    return Scrypt(salt=salt, **SCRYPT_PARAMS).derive(passphrase.encode('utf-8'))
+
+
+def _nonce(prefix, counter, last):
+    return prefix + struct.pack('>IB', counter, 1 if last else 0)
+
+
+def encrypt_stream(chunks, passphrase):
+    """
+    Wrap a stream of byte chunks in the authenticated container.
+    Holds one chunk of lookahead so the final frame can be flagged.
+    :param chunks: Iterable of bytes
+    :param passphrase: Secret the reader will need
+    """
+    salt, prefix = os.urandom(SALT_SIZE), os.urandom(PREFIX_SIZE)
+    header = MAGIC + salt + prefix
+    aead = AESGCM(_derive_key(passphrase, salt))
+    yield header
+
+    counter, pending = 0, b''
+    for chunk in chunks:
+        if pending:
+            frame = aead.encrypt(_nonce(prefix, counter, False), pending, header)
+            yield struct.pack('>I', len(frame)) + frame
+            counter += 1
+        pending = chunk
+    frame = aead.encrypt(_nonce(prefix, counter, True), pending, header)
+    yield struct.pack('>I', len(frame)) + frame
+
+
+def decrypt_stream(source, passphrase):
+    """
+    Read a container written by encrypt_stream and yield plaintext chunks.
+    Raises ValueError on a wrong passphrase, tampering or truncation.
+    :param source: Binary file object
+    :param passphrase: Secret used for the export
+    """
+    header = source.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or not header.startswith(MAGIC):
+        raise ValueError("Not an encrypted vault export.")
+    salt = header[len(MAGIC):len(MAGIC) + SALT_SIZE]
+    prefix = header[len(MAGIC) + SALT_SIZE:]
+    aead = AESGCM(_derive_key(passphrase, salt))
+
+    counter = 0
+    length = source.read(4)
+    while length:
+        if len(length) != 4:
+            raise ValueError("Encrypted export is truncated.")
+        frame = source.read(struct.unpack('>I', length)[0])
+        length = source.read(4)
+        last = not length
+        try:
+            yield aead.decrypt(_nonce(prefix, counter, last), frame, header)
+        except InvalidTag:
+            raise ValueError("Wrong passphrase, or the export was modified or truncated.") from None
+        counter += 1
+    if counter == 0:
+        raise ValueError("Encrypted export is truncated.")
@@ -0,0 +1,199 @@
+# Vault Import using Strategy Pattern
+import csv
+import json
+import time
+from collections import namedtuple
+from urllib.parse import urlparse
+
+
+ImportedItem = namedtuple('ImportedItem', ['line', 'item_type', 'name', 'details'])
+ImportReport = namedtuple('ImportReport', ['imported', 'failed', 'errors', 'seconds', 'rows_per_sec'])
+
+MAX_NAME_LENGTH = 120
+MAX_TYPE_LENGTH = 50
+MAX_KEY_LENGTH = 120
+
+
+class ImportRowError(ValueError):
+    def __init__(self, line, message):
+        super().__init__(f"Line {line}: {message}")
+        self.line = line
+
+
+class CsvLayout:
+    def __init__(self, name, required, name_column, details, item_type=None):
+        """
+        Describe one password manager's CSV export.
+        :param name: Short label of the layout
+        :param required: Header columns that identify the layout
+        :param name_column: Column holding the item name
+        :param details: Mapping of our detail key -> CSV column
+        :param item_type: Callable(row) -> item type, 'Login' when omitted
+        """
+        self.name = name
+        self.required = set(required)
+        self.name_column = name_column
+        self.details = details
+        self.item_type = item_type or (lambda row: 'Login')
+
+    def matches(self, header):
+        return self.required <= set(header)
+
+    def parse(self, line, row):
+        name = (row.get(self.name_column) or '').strip()
+        url = (row.get(self.details.get('url', '')) or '').strip()
+        if not name and url:
+            name = urlparse(url).hostname or url
+        details = [(key, row[column]) for key, column in self.details.items() if row.get(column)]
+        return ImportedItem(line, self.item_type(row), name, details)
+
+
+BITWARDEN_TYPES = {'login': 'Login', 'card': 'Credit Card', 'identity': 'Identity', 'note': 'Secure Note'}
+
+# Most specific layouts first; the first one whose header matches wins
+CSV_LAYOUTS = [
+    CsvLayout('bitwarden', {'type', 'name', 'login_username', 'login_password'}, 'name',
+              {'url': 'login_uri', 'username': 'login_username', 'password': 'login_password',
+               'totp': 'login_totp', 'notes': 'notes'},
+              item_type=lambda row: BITWARDEN_TYPES.get(row.get('type'), 'Login')),
+    CsvLayout('lastpass', {'url', 'username', 'password', 'extra', 'name', 'grouping'}, 'name',
+              {'url': 'url', 'username': 'username', 'password': 'password',
+               'totp': 'totp', 'notes': 'extra'},
+              item_type=lambda row: 'Secure Note' if row.get('url') == 'http://sn' else 'Login'),
+    CsvLayout('1password', {'Title', 'Username', 'Password'}, 'Title',
+              {'url': 'Url', 'username': 'Username', 'password': 'Password',
+               'totp': 'OTPAuth', 'notes': 'Notes'}),
+    CsvLayout('browser', {'url', 'username', 'password'}, 'name',
+              {'url': 'url', 'username': 'username', 'password': 'password', 'notes': 'note'}),
+]
+
+
+def parse_csv(lines):
+    """
+    Lazily parse a password-manager CSV export, one item per row.
+    Yields ImportedItem or ImportRowError, so one bad row never stops
+    the rest of the file.
+    :param lines: Text stream opened with newline=''
+    """
+    reader = csv.DictReader(lines)
+    header = reader.fieldnames or []
+    layout = next((layout for layout in CSV_LAYOUTS if layout.matches(header)), None)
+    if layout is None:
+        raise ValueError("Unrecognized CSV layout: " + ', '.join(header))
+    for row in reader:
+        try:
+            yield layout.parse(reader.line_num, row)
+        except (TypeError, ValueError) as e:
+            yield ImportRowError(reader.line_num, str(e))
+
+
+def parse_json_lines(lines):
+    """
+    Lazily parse our own JSON format: one object per line shaped like the
+    items returned by /api/vault, e.g.
+    {"name":"Gmail","item_type":"Login","details":[{"key":"username","value":"me"}]}
+    :param lines: Text stream
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            details = [(d['key'], d['value']) for d in record.get('details', [])]
+            yield ImportedItem(line_number, record.get('item_type') or 'Login',
+                               record.get('name') or '', details)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            yield ImportRowError(line_number, f"Invalid JSON record ({e})")
+
+
+PARSERS = {'csv': parse_csv, 'json': parse_json_lines}
+
+
+def detect_format(filename):
+    return 'csv' if (filename or '').lower().endswith('.csv') else 'json'
+
+
+def validate(item):
+    if not item.name:
+        raise ImportRowError(item.line, "Item name is missing.")
+    if len(item.name) > MAX_NAME_LENGTH:
+        raise ImportRowError(item.line, f"Item name is longer than {MAX_NAME_LENGTH} characters.")
+    if len(item.item_type) > MAX_TYPE_LENGTH:
+        raise ImportRowError(item.line, f"Item type is longer than {MAX_TYPE_LENGTH} characters.")
+    for key, value in item.details:
+        if not isinstance(key, str) or not isinstance(value, str) or not key:
+            raise ImportRowError(item.line, "Detail keys and values must be non-empty text.")
+        if len(key) > MAX_KEY_LENGTH:
+            raise ImportRowError(item.line, f"Detail key '{key[:20]}...' is too long.")
+    return item
+
+
+class VaultImporter:
+    def __init__(self, repository, cipher, batch_size=500, max_errors=100, progress=None):
+        """
+        :param repository: VaultRepository used to write the batches
+        :param cipher: The owner's data key cipher
+        :param batch_size: Items committed per transaction
+        :param max_errors: Row errors kept for the report; later ones are only counted
+        :param progress: Optional callable(imported, failed, rows_per_sec) run after each batch
+        """
+        self.repository = repository
+        self.cipher = cipher
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.progress = progress
+
+    def run(self, user_id, records):
+        """
+        Insert parsed records in batched transactions.
+        Only one batch is held in memory at a time.
+        :param user_id: Owner of the imported items
+        :param records: Iterable from one of the PARSERS
+        """
+        start = time.perf_counter()
+        imported, failed, errors, batch = 0, 0, [], []
+
+        def record_error(error):
+            nonlocal failed
+            failed += 1
+            if len(errors) < self.max_errors:
+                errors.append(str(error))
+
+        def flush():
+            nonlocal imported
+            try:
+                self.repository.create_items(user_id, batch, self.cipher)
+                imported += len(batch)
+            except Exception:
+                # Retry row by row to find the rows the database rejects
+                for item in batch:
+                    try:
+                        self.repository.create_item(user_id, item.item_type, item.name, item.details, self.cipher)
+                        imported += 1
+                    except Exception as e:
+                        record_error(ImportRowError(item.line, f"Could not be saved ({e.__class__.__name__})."))
+            batch.clear()
+            if self.progress:
+                self.progress(imported, failed, _rate(imported + failed, start))
+
+        for record in records:
+            if isinstance(record, ImportRowError):
+                record_error(record)
+                continue
+            try:
+                batch.append(validate(record))
+            except ImportRowError as e:
+                record_error(e)
+                continue
+            if len(batch) >= self.batch_size:
+                flush()
+        if batch:
+            flush()
+
+        seconds = time.perf_counter() - start
+        return ImportReport(imported, failed, errors, seconds, _rate(imported + failed, start))
+
+
+def _rate(rows, start):
+    elapsed = time.perf_counter() - start
+    return rows / elapsed if elapsed > 0 else 0.0
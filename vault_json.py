@@ -0,0 +1,97 @@
+# Vault JSON Encoding using Iterator Pattern
+import json
+from models import decrypt_many
+from vault_repository import encode_cursor
+
+
+ITEM_FIELDS = ('id', 'name', 'item_type', 'version', 'created_at', 'updated_at')
+DETAIL_FIELDS = ('details', 'details.key')
+DEFAULT_FIELDS = ('id', 'name', 'item_type', 'version', 'details')
+
+# Compact, separator-free encoding shared by every JSON vault response
+encode = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+
+
+def parse_fields(raw):
+    """
+    Parse a fields= projection such as "name,item_type" or "id,details.key".
+    "details" returns detail keys and secret values, "details.key" only keys.
+    :param raw: Comma-separated field names, or None for the defaults
+    """
+    if not raw:
+        return DEFAULT_FIELDS
+    fields = tuple(dict.fromkeys(f.strip() for f in raw.split(',') if f.strip()))
+    unknown = [f for f in fields if f not in ITEM_FIELDS + DETAIL_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+    return fields
+
+
+def wants_details(fields):
+    return any(f in DETAIL_FIELDS for f in fields)
+
+
+def wants_values(fields):
+    return 'details' in fields
+
+
+def iter_items(rows, fields, cipher=None):
+    """
+    Fold flat (item, detail) rows into one JSON-ready dict per item.
+    Only the item currently being assembled is held in memory.
+    :param rows: Rows from VaultRepository.item_rows, grouped by item
+    :param fields: Projection returned by parse_fields
+    :param cipher: The owner's data key cipher; required when values are projected
+    """
+    item_fields = [f for f in ITEM_FIELDS if f in fields]
+    with_details = wants_details(fields)
+    with_values = wants_values(fields)
+    current, current_row = None, None
+
+    def finish(row, item):
+        # Decrypt the values of one item as a single batch under its key
+        if with_values and item['details']:
+            values = decrypt_many([d['value'] for d in item['details']], cipher.item_cipher(row.wrapped_key))
+            for detail, value in zip(item['details'], values):
+                detail['value'] = value
+        return item
+
+    for row in rows:
+        if current_row is None or row.id != current_row.id:
+            if current_row is not None:
+                yield current_row, finish(current_row, current)
+            current_row = row
+            current = {}
+            for field in item_fields:
+                value = getattr(row, field)
+                current[field] = value.isoformat() if hasattr(value, 'isoformat') else value
+            if with_details:
+                current['details'] = []
+        if with_details and row.detail_key is not None:
+            detail = {'key': row.detail_key}
+            if with_values:
+                detail['value'] = row.detail_value
+            current['details'].append(detail)
+
+    if current_row is not None:
+        yield current_row, finish(current_row, current)
+
+
+def stream_page(rows, fields, limit, cipher=None):
+    """
+    Encode a page of items as {"items":[...],"next_cursor":...} piece by
+    piece. The rows hold one item past the page to detect the next page.
+    :param rows: Rows from VaultRepository.item_rows
+    :param fields: Projection returned by parse_fields
+    :param limit: Page size the rows were fetched with
+    :param cipher: The owner's data key cipher
+    """
+    yield '{"items":['
+    last_row, next_cursor = None, None
+    for count, (row, item) in enumerate(iter_items(rows, fields, cipher)):
+        if count == limit:
+            next_cursor = encode_cursor(last_row)
+            break
+        yield (',' if count else '') + encode(item)
+        last_row = row
+    yield '],"next_cursor":' + encode(next_cursor) + '}'
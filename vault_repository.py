@@ -0,0 +1,371 @@
+# Vault Data Access using Repository Pattern
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import delete, insert, select, tuple_, update
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.exc import StaleDataError
+from models import db, User, VaultItem, VaultDetail, encrypt_many, decrypt_many
+
+
+VaultPage = namedtuple('VaultPage', ['items', 'next_cursor'])
+VaultRevision = namedtuple('VaultRevision', ['version', 'updated_at'])
+
+
+class VersionConflict(Exception):
+    def __init__(self, item_ids):
+        super().__init__("The item was changed or deleted by another session.")
+        self.item_ids = list(item_ids)
+
+
+def encode_cursor(item):
+    """
+    Build an opaque cursor pointing just past the given item.
+    :param item: Last item of the current page
+    """
+    raw = json.dumps([item.name, item.id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Turn a cursor produced by encode_cursor back into its (name, id) key.
+    Raises ValueError if the cursor was tampered with or is malformed.
+    :param cursor: Opaque cursor string from the query string
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        name, item_id = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid page cursor.") from e
+    if not isinstance(name, str) or not isinstance(item_id, int):
+        raise ValueError("Invalid page cursor.")
+    return name, item_id
+
+
+class VaultRepository:
+    def revision(self, user_id):
+        """
+        Current vault version and last write time of a user, read with a
+        single primary-key lookup on users.
+        :param user_id: Owner of the vault
+        """
+        row = (db.session.query(User.vault_version, User.vault_updated_at)
+               .filter_by(id=user_id).first())
+        return VaultRevision(*row) if row else VaultRevision(0, None)
+
+    def bump_version(self, user_id):
+        """
+        Mark a user's vault as changed. Runs inside the caller's transaction,
+        so the new version becomes visible together with the write itself.
+        :param user_id: Owner of the vault
+        """
+        db.session.execute(
+            update(User).where(User.id == user_id).values(
+                vault_version=User.vault_version + 1,
+                vault_updated_at=datetime.utcnow(),
+            )
+        )
+
+    def create_item(self, user_id, item_type, name, details, cipher):
+        """
+        Create a vault item and all of its details in one transaction.
+        The item is flushed to get its id, then every detail goes in with a
+        single executemany INSERT, and the whole thing commits once.
+        :param user_id: Owner of the new item
+        :param item_type: 'Login', 'Credit Card', etc.
+        :param name: Friendly name for the item
+        :param details: Iterable of (key, value) pairs
+        :param cipher: The owner's data key cipher
+        """
+        try:
+            item_cipher, wrapped_key = cipher.new_item_key()
+            item = VaultItem(user_id=user_id, item_type=item_type, name=name, wrapped_key=wrapped_key)
+            db.session.add(item)
+            db.session.flush()
+
+            details = list(details)
+            values = encrypt_many([value for _, value in details], item_cipher)
+            rows = [{'vault_item_id': item.id, 'key': key, 'value': value}
+                    for (key, _), value in zip(details, values)]
+            if rows:
+                db.session.execute(insert(VaultDetail), rows)
+
+            self.bump_version(user_id)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return item
+
+    def create_items(self, user_id, items, cipher):
+        """
+        Create many vault items and their details in one transaction.
+        Items go in with one multi-row INSERT ... RETURNING id, which hands
+        back ids in parameter order, then all details with one executemany.
+        :param user_id: Owner of the new items
+        :param items: Sequence of objects with item_type, name and details
+        :param cipher: The owner's data key cipher
+        """
+        try:
+            item_keys = [cipher.new_item_key() for _ in items]
+            item_ids = db.session.scalars(
+                insert(VaultItem).returning(VaultItem.id, sort_by_parameter_order=True),
+                [{'user_id': user_id, 'item_type': item.item_type, 'name': item.name, 'wrapped_key': wrapped_key}
+                 for item, (_, wrapped_key) in zip(items, item_keys)],
+            ).all()
+
+            rows = []
+            for item_id, item, (item_cipher, _) in zip(item_ids, items, item_keys):
+                values = encrypt_many([value for _, value in item.details], item_cipher)
+                rows += [{'vault_item_id': item_id, 'key': key, 'value': value}
+                         for (key, _), value in zip(item.details, values)]
+            if rows:
+                db.session.execute(insert(VaultDetail), rows)
+
+            self.bump_version(user_id)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return item_ids
+
+    def update_item(self, item, expected_version, name, item_type, details, cipher):
+        """
+        Save an edited item by diffing the submitted details against the
+        stored rows and writing only what changed, in one transaction.
+        Details are matched by key, in order, so an unchanged field costs
+        nothing and a changed value is a single UPDATE of that row.
+        Returns True if anything was written. Raises VersionConflict if the
+        item is no longer at expected_version, including when another
+        writer gets in between this read and the UPDATE.
+        :param item: VaultItem being edited
+        :param expected_version: Version the editor started from
+        :param name: Submitted item name
+        :param item_type: Submitted item type
+        :param details: Submitted (key, value) pairs
+        :param cipher: The owner's data key cipher
+        """
+        if item.version != expected_version:
+            raise VersionConflict([item.id])
+
+        stored = {}
+        item_cipher = cipher.item_cipher(item.wrapped_key)
+        current = sorted(item.details, key=lambda d: d.id)
+        plaintext = dict(zip((d.id for d in current), decrypt_many([d.value for d in current], item_cipher)))
+        for detail in current:
+            stored.setdefault(detail.key, []).append(detail)
+
+        updates, inserts, kept = [], [], []
+        changed = False
+        try:
+            for key, value in details:
+                matches = stored.get(key)
+                if matches:
+                    detail = matches.pop(0)
+                    if plaintext[detail.id] != value:
+                        updates.append((detail, value))
+                    else:
+                        kept.append(detail)
+                else:
+                    inserts.append((key, value))
+            removed = [detail.id for matches in stored.values() for detail in matches]
+
+            if item.wrapped_key is None and (updates or inserts or removed
+                                             or item.name != name or item.item_type != item_type):
+                # First write to an item created before items had keys:
+                # give it one and move all of its values under it
+                item_cipher, item.wrapped_key = cipher.new_item_key()
+                updates += [(detail, plaintext[detail.id]) for detail in kept]
+
+            # Encrypt everything that has to be written in one batch
+            tokens = encrypt_many([value for _, value in updates + inserts], item_cipher)
+            for (detail, _), token in zip(updates, tokens):
+                detail.value = token
+                changed = True
+            inserts = [{'vault_item_id': item.id, 'key': key, 'value': token}
+                       for (key, _), token in zip(inserts, tokens[len(updates):])]
+
+            if removed:
+                db.session.execute(
+                    delete(VaultDetail).where(VaultDetail.id.in_(removed))
+                    .execution_options(synchronize_session=False)
+                )
+            if inserts:
+                db.session.execute(insert(VaultDetail), inserts)
+
+            if item.name != name:
+                item.name = name
+            if item.item_type != item_type:
+                item.item_type = item_type
+            changed = changed or bool(inserts or removed) or item in db.session.dirty
+            if not changed:
+                db.session.rollback()
+                return False
+
+            item.updated_at = datetime.utcnow()
+            self.bump_version(item.user_id)
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise VersionConflict([item.id]) from None
+        except Exception:
+            db.session.rollback()
+            raise
+        return True
+
+    def delete_items(self, user_id, item_versions):
+        """
+        Delete any number of a user's items with one DELETE statement.
+        Their details go with them through ON DELETE CASCADE in the database.
+        Nothing is deleted if any item has moved past its expected version;
+        items that are already gone are skipped.
+        Returns how many items were actually deleted.
+        :param user_id: Owner of the items
+        :param item_versions: Mapping of item id -> expected version
+        """
+        if not item_versions:
+            return 0
+        try:
+            result = db.session.execute(
+                delete(VaultItem)
+                .where(VaultItem.user_id == user_id,
+                       tuple_(VaultItem.id, VaultItem.version).in_(list(item_versions.items())))
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount < len(item_versions):
+                # Whatever is still there was modified since it was read
+                stale = db.session.scalars(
+                    select(VaultItem.id).where(VaultItem.user_id == user_id,
+                                               VaultItem.id.in_(list(item_versions)))
+                ).all()
+                if stale:
+                    raise VersionConflict(stale)
+            if result.rowcount:
+                self.bump_version(user_id)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return result.rowcount
+
+    def iter_items(self, user_id, batch_size=100):
+        """
+        Lazily walk a user's whole vault ordered by (name, id).
+        Rows are fetched batch_size at a time, with one details query per
+        batch, so memory use does not grow with the size of the vault.
+        :param user_id: Owner of the items
+        :param batch_size: Items fetched per round trip
+        """
+        return (VaultItem.query
+                .options(selectinload(VaultItem.details))
+                .filter_by(user_id=user_id)
+                .order_by(VaultItem.name, VaultItem.id)
+                .yield_per(batch_size))
+
+    def page_query(self, user_id, cursor=None, limit=50):
+        """
+        Query for one page of a user's vault ordered by (name, id), plus one
+        extra row that tells whether another page follows.
+        :param user_id: Owner of the items
+        :param cursor: Cursor returned with the previous page, or None
+        :param limit: Maximum number of items on the page
+        """
+        query = (VaultItem.query
+                 .options(selectinload(VaultItem.details))
+                 .filter_by(user_id=user_id))
+        if cursor:
+            query = query.filter(tuple_(VaultItem.name, VaultItem.id) > decode_cursor(cursor))
+        return query.order_by(VaultItem.name, VaultItem.id).limit(limit + 1)
+
+    def page(self, user_id, cursor=None, limit=50):
+        """
+        Fetch one page of a user's vault ordered by (name, id).
+        Seeks past the cursor key instead of using OFFSET, so every page
+        costs the same no matter how deep into the vault it is.
+        :param user_id: Owner of the items
+        :param cursor: Cursor returned with the previous page, or None
+        :param limit: Maximum number of items on the page
+        """
+        items = self.page_query(user_id, cursor=cursor, limit=limit).all()
+        if len(items) > limit:
+            items = items[:limit]
+            return VaultPage(items, encode_cursor(items[-1]))
+        return VaultPage(items, None)
+
+    def item_rows(self, user_id, cursor=None, limit=50, item_id=None,
+                  with_details=True, with_values=True, batch_size=200):
+        """
+        Execute item_rows_statement and stream its rows. With limit=None
+        the whole vault is walked one keyset page of batch_size items at a
+        time, in the same order.
+        :param batch_size: Rows fetched from the cursor per round trip, or
+                           items per query when walking the whole vault
+        """
+        if limit is None and item_id is None:
+            return self._walk_item_rows(user_id, cursor, with_details, with_values, batch_size)
+        stmt = self.item_rows_statement(user_id, cursor=cursor, limit=limit, item_id=item_id,
+                                        with_details=with_details, with_values=with_values)
+        return db.session.execute(stmt.execution_options(yield_per=batch_size))
+
+    def _walk_item_rows(self, user_id, cursor, with_details, with_values, batch_size):
+        # A whole vault is read as keyset pages of batch_size items, so the
+        # sort by (name, id, detail) only ever covers one page and the first
+        # row arrives without the database ordering the entire vault first
+        while True:
+            stmt = self.item_rows_statement(user_id, cursor=cursor, limit=batch_size,
+                                            with_details=with_details, with_values=with_values)
+            result = db.session.execute(stmt)
+            item_ids, last_row = set(), None
+            try:
+                for row in result:
+                    if row.id not in item_ids:
+                        if len(item_ids) == batch_size:
+                            break  # First row of the look-ahead item: another page follows
+                        item_ids.add(row.id)
+                    last_row = row
+                    yield row
+                else:
+                    return
+            finally:
+                result.close()
+            cursor = encode_cursor(last_row)
+
+    def item_rows_statement(self, user_id, cursor=None, limit=50, item_id=None,
+                            with_details=True, with_values=True):
+        """
+        Select flat (item, detail) rows for a page of a user's vault in one
+        query, ordered so each item's details arrive next to each other.
+        The page itself is picked by a keyset subquery on (name, id) that
+        asks for one extra item, so callers can tell if another page follows.
+        :param user_id: Owner of the items
+        :param cursor: Cursor returned with the previous page, or None
+        :param limit: Maximum number of items on the page, or None for all
+        :param item_id: Restrict the result to this one item
+        :param with_details: Join vault_details and return detail keys
+        :param with_values: Also return the secret detail values
+        """
+        page_ids = select(VaultItem.id).where(VaultItem.user_id == user_id)
+        if item_id is not None:
+            page_ids = page_ids.where(VaultItem.id == item_id)
+        if cursor:
+            page_ids = page_ids.where(tuple_(VaultItem.name, VaultItem.id) > decode_cursor(cursor))
+        page_ids = page_ids.order_by(VaultItem.name, VaultItem.id)
+        if limit is not None:
+            page_ids = page_ids.limit(limit + 1)
+        page_ids = page_ids.subquery()
+
+        columns = [VaultItem.id, VaultItem.name, VaultItem.item_type,
+                   VaultItem.version, VaultItem.created_at, VaultItem.updated_at]
+        if with_details:
+            columns.append(VaultDetail.key.label('detail_key'))
+            if with_values:
+                columns += [VaultDetail.value.label('detail_value'), VaultItem.wrapped_key]
+
+        stmt = select(*columns).join(page_ids, VaultItem.id == page_ids.c.id)
+        order_by = [VaultItem.name, VaultItem.id]
+        if with_details:
+            stmt = stmt.outerjoin(VaultDetail, VaultDetail.vault_item_id == VaultItem.id)
+            order_by.append(VaultDetail.id)
+        return stmt.order_by(*order_by)
@@ -0,0 +1,129 @@
+# Full-Text Vault Search backed by an SQLite FTS5 index
+import re
+from collections import namedtuple
+from sqlalchemy import text
+
+
+SearchResult = namedtuple('SearchResult', ['id', 'name', 'item_type'])
+SearchPage = namedtuple('SearchPage', ['results', 'page', 'has_next'])
+
+# One FTS row per vault item, keyed by the item id. Detail values are
+# secrets and never leave vault_details; only their keys are indexed.
+SEARCH_TABLE_DDL = """
+CREATE VIRTUAL TABLE vault_search USING fts5(
+    name, item_type, detail_keys,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)
+"""
+
+_REFRESH_DETAIL_KEYS = """
+    UPDATE vault_search
+    SET detail_keys = (SELECT coalesce(group_concat("key", ' '), '')
+                       FROM vault_details WHERE vault_item_id = {ref}.vault_item_id)
+    WHERE rowid = {ref}.vault_item_id;
+"""
+
+# Triggers keep the index in step with every write, including bulk and
+# raw SQL writes that never pass through the ORM.
+SEARCH_TRIGGERS = {
+    'vault_items_search_insert': """
+        CREATE TRIGGER vault_items_search_insert AFTER INSERT ON vault_items BEGIN
+            INSERT INTO vault_search (rowid, name, item_type, detail_keys)
+            VALUES (new.id, new.name, new.item_type, '');
+        END
+    """,
+    'vault_items_search_update': """
+        CREATE TRIGGER vault_items_search_update AFTER UPDATE OF name, item_type ON vault_items BEGIN
+            UPDATE vault_search SET name = new.name, item_type = new.item_type WHERE rowid = new.id;
+        END
+    """,
+    'vault_items_search_delete': """
+        CREATE TRIGGER vault_items_search_delete AFTER DELETE ON vault_items BEGIN
+            DELETE FROM vault_search WHERE rowid = old.id;
+        END
+    """,
+    'vault_details_search_insert': f"""
+        CREATE TRIGGER vault_details_search_insert AFTER INSERT ON vault_details BEGIN
+            {_REFRESH_DETAIL_KEYS.format(ref='new')}
+        END
+    """,
+    'vault_details_search_update': f"""
+        CREATE TRIGGER vault_details_search_update AFTER UPDATE OF "key", vault_item_id ON vault_details BEGIN
+            {_REFRESH_DETAIL_KEYS.format(ref='old')}
+            {_REFRESH_DETAIL_KEYS.format(ref='new')}
+        END
+    """,
+    'vault_details_search_delete': f"""
+        CREATE TRIGGER vault_details_search_delete AFTER DELETE ON vault_details BEGIN
+            {_REFRESH_DETAIL_KEYS.format(ref='old')}
+        END
+    """,
+}
+
+_BACKFILL = """
+    INSERT INTO vault_search (rowid, name, item_type, detail_keys)
+    SELECT vault_items.id, vault_items.name, vault_items.item_type,
+           coalesce((SELECT group_concat("key", ' ') FROM vault_details
+                     WHERE vault_details.vault_item_id = vault_items.id), '')
+    FROM vault_items
+"""
+
+SEARCH_SQL = """
+    SELECT vault_items.id, vault_items.name, vault_items.item_type
+    FROM vault_search
+    JOIN vault_items ON vault_items.id = vault_search.rowid
+    WHERE vault_search MATCH :match AND vault_items.user_id = :user_id
+    ORDER BY bm25(vault_search, 10.0, 2.0, 1.0), vault_items.id
+    LIMIT :limit OFFSET :offset
+"""
+
+
+def install_search_index(session):
+    """
+    Create the FTS table and its triggers if they are missing. A newly
+    created table is filled from the existing vault items.
+    :param session: SQLAlchemy session to run the DDL on
+    """
+    existing = {row[0] for row in session.execute(
+        text("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')"))}
+    if 'vault_search' not in existing:
+        session.execute(text(SEARCH_TABLE_DDL))
+        session.execute(text(_BACKFILL))
+    for name, ddl in SEARCH_TRIGGERS.items():
+        if name not in existing:
+            session.execute(text(ddl))
+
+
+def build_match_query(query):
+    """
+    Turn free text typed by a user into a safe FTS5 MATCH expression.
+    Every word becomes a quoted prefix term and all of them must match.
+    :param query: Raw search text
+    """
+    terms = re.findall(r'\w+', query or '')
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def search_items(session, user_id, query, page=1, per_page=20):
+    """
+    Rank a user's vault items against a search query, best match first.
+    Names weigh more than item types, which weigh more than detail keys.
+    :param session: SQLAlchemy session
+    :param user_id: Owner of the items
+    :param query: Raw search text
+    :param page: 1-based page number
+    :param per_page: Results per page
+    """
+    match = build_match_query(query)
+    if not match:
+        return SearchPage([], page, False)
+
+    rows = session.execute(text(SEARCH_SQL), {
+        'match': match,
+        'user_id': user_id,
+        'limit': per_page + 1,
+        'offset': (page - 1) * per_page,
+    }).all()
+    results = [SearchResult(*row) for row in rows[:per_page]]
+    return SearchPage(results, page, len(rows) > per_page)